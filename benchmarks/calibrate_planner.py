@@ -0,0 +1,72 @@
+"""Refit the runtime and memory model of fw_gear_tedana.planner to real tedana runs.
+
+Each argument pair is the execution plan of a dry run (tedana_plan_<id>.json) and
+the metrics of a real run on the same inputs (tedana_metrics_<id>.json). Tasks are
+matched by name; the tedana phase of each task gives its measured runtime and peak
+memory. Peak memory is only used from runs with one worker, since the memory of
+concurrent runs is measured together.
+
+Examples:
+    $ python benchmarks/calibrate_planner.py plan_a.json metrics_a.json plan_b.json metrics_b.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+from pathlib import Path
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+from fw_gear_tedana import planner  # noqa: E402
+
+
+def observations(plan_path, metrics_path):
+    """Yield (plan task, threads, workers, measured tedana phase) of the tasks of a run."""
+    with open(plan_path) as f:
+        plan = json.load(f)
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    for task in plan["tasks"]:
+        measured = metrics["tasks"].get(task["task"], {}).get("tedana")
+        if measured and task["voxels"]:
+            yield task, plan["threads_per_task"], plan["n_workers"], measured
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="plan and metrics files, in pairs")
+    args = parser.parse_args()
+    if len(args.files) % 2:
+        parser.error("plan and metrics files must be given in pairs")
+
+    rows = []
+    memory_ratios = []
+    for plan_path, metrics_path in zip(args.files[::2], args.files[1::2]):
+        for task, n_threads, n_workers, measured in observations(plan_path, metrics_path):
+            samples = task["voxels"] * task["volumes"] * len(task["echo_files"])
+            speedup = (1 - planner.PARALLEL_FRACTION) + planner.PARALLEL_FRACTION / n_threads
+            rows.append((samples * speedup, measured["seconds"]))
+            if n_workers == 1 and measured.get("peak_rss"):
+                raw_estimate = task["estimated_memory_bytes"] - planner.BASE_MEMORY
+                memory_ratios.append((measured["peak_rss"] - planner.BASE_MEMORY) / raw_estimate)
+
+    if len(rows) < 2:
+        sys.exit("At least 2 measured tasks are needed, found %d" % len(rows))
+
+    x, y = np.array(rows).T
+    (per_sample, base), *_ = np.linalg.lstsq(np.stack([x, np.ones_like(x)], axis=1), y, rcond=None)
+    print("Fitted on %d tasks" % len(rows))
+    print("RUNTIME_PER_SAMPLE = %.3e  # was %.3e" % (per_sample, planner.RUNTIME_PER_SAMPLE))
+    print("BASE_RUNTIME = %.1f  # was %.1f" % (base, planner.BASE_RUNTIME))
+    if memory_ratios:
+        multiplier = planner.MEMORY_MULTIPLIER * statistics.median(memory_ratios)
+        print("MEMORY_MULTIPLIER = %.1f  # was %.1f, from %d single-worker tasks"
+              % (multiplier, planner.MEMORY_MULTIPLIER, len(memory_ratios)))
+
+
+if __name__ == "__main__":
+    main()
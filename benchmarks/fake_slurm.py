@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Local stand-in for sbatch, squeue and sacct, to exercise the slurm-array engine.
+
+Installed on the PATH under those three names (see install), it runs every element
+of a submitted job array as a local background process, and answers squeue and
+sacct from state files kept in $FAKE_SLURM_DIR. Only the options used by the gear
+are understood.
+
+Examples:
+    $ python benchmarks/fake_slurm.py install /tmp/bin && export PATH=/tmp/bin:$PATH
+    $ sbatch --parsable job.sh
+    1
+    $ squeue -h -j 1 -o "%i %T"
+    1_0 RUNNING
+"""
+
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+STATE_DIR = Path(os.environ.get("FAKE_SLURM_DIR", "/tmp/fake-slurm"))
+COMMANDS = ["sbatch", "squeue", "sacct"]
+
+
+def _job_dir(job_id):
+    return STATE_DIR / str(job_id)
+
+
+def _states(job_id):
+    """Return {index: (state, exit code)} of a job array."""
+    states = {}
+    for path in sorted(_job_dir(job_id).glob("*.state")):
+        state, _, exit_code = path.read_text().strip().partition("|")
+        states[int(path.stem)] = (state, exit_code or "0:0")
+    return states
+
+
+def _set_state(job_id, index, state, exit_code="0:0"):
+    path = _job_dir(job_id) / ("%d.state" % index)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text("%s|%s\n" % (state, exit_code))
+    tmp.replace(path)
+
+
+def sbatch(args):
+    script = Path([a for a in args if not a.startswith("-")][-1])
+    options = dict(re.findall(r"^#SBATCH --([\w-]+)=(.*)$", script.read_text(), re.M))
+    first, _, last = options.get("array", "0-0").partition("-")
+
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    counter = STATE_DIR / "last-job-id"
+    job_id = int(counter.read_text()) + 1 if counter.exists() else 1
+    counter.write_text(str(job_id))
+    _job_dir(job_id).mkdir()
+
+    for index in range(int(first), int(last or first) + 1):
+        _set_state(job_id, index, "PENDING")
+        output = options.get("output", "slurm-%A_%a.out").replace("%A", str(job_id)).replace("%a", str(index))
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "_element", str(job_id), str(index), str(script), output,
+             options.get("cpus-per-task", "1")],
+            start_new_session=True, stdin=subprocess.DEVNULL,
+        )
+    print(job_id if "--parsable" in args else "Submitted batch job %d" % job_id)
+    return 0
+
+
+def element(job_id, index, script, output, cpus):
+    env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=index,
+               SLURM_CPUS_PER_TASK=cpus)
+    _set_state(job_id, int(index), "RUNNING")
+    with open(output, "w") as log:
+        code = subprocess.call(["bash", script], env=env, stdout=log, stderr=subprocess.STDOUT)
+    _set_state(job_id, int(index), "COMPLETED" if code == 0 else "FAILED", "%d:0" % code)
+    return 0
+
+
+def _job_arg(args):
+    return args[args.index("-j") + 1]
+
+
+def squeue(args):
+    job_id = _job_arg(args)
+    if not _job_dir(job_id).exists():
+        print("slurm_load_jobs error: Invalid job id specified", file=sys.stderr)
+        return 1
+    for index, (state, _) in _states(job_id).items():
+        if state in ("PENDING", "RUNNING"):
+            print("%s_%d %s" % (job_id, index, state))
+    return 0
+
+
+def sacct(args):
+    job_id = _job_arg(args)
+    for index, (state, exit_code) in _states(job_id).items():
+        print("%s_%d|%s|%s" % (job_id, index, state, exit_code))
+    return 0
+
+
+def install(bin_dir):
+    """Write sbatch, squeue and sacct wrappers to bin_dir."""
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name in COMMANDS:
+        wrapper = bin_dir / name
+        wrapper.write_text('#!/bin/sh\nexec %s %s %s "$@"\n' % (sys.executable, os.path.abspath(__file__), name))
+        wrapper.chmod(0o755)
+
+
+def main(argv):
+    name, args = (argv[1], argv[2:]) if len(argv) > 1 else (os.path.basename(argv[0]), [])
+    if name == "install":
+        install(args[0])
+        return 0
+    if name == "_element":
+        return element(*args)
+    return {"sbatch": sbatch, "squeue": squeue, "sacct": sacct}[name](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
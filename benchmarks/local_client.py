@@ -0,0 +1,149 @@
+"""Offline stand-in for the Flywheel client, backed by a folder tree.
+
+The tree mirrors the Flywheel hierarchy::
+
+    root/<project>/analyses/<analysis>/<files>
+    root/<project>/<subject>/analyses/<analysis>/<files>
+    root/<project>/<subject>/<session>/analyses/<analysis>/<files>
+
+Containers expose the attributes and methods the gear uses (id, label, parent,
+parents, sessions(), analyses, files, created, download_file), so the gear can run
+at the session level or in batch mode without a Flywheel instance. Every get can be
+delayed to simulate the round trip to a platform, and the calls are counted.
+
+Examples:
+    >>> client = LocalClient("/tmp/fw")
+    >>> project = client.add_container("project", "study")
+    >>> analysis = client.add_analysis(project.id, "tedana")
+    >>> client.get(analysis.id).parent.type
+    'project'
+    >>> client.requests
+    1
+"""
+
+import datetime
+import os
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+
+ANALYSES = "analyses"
+SEP = "~"
+
+
+class LocalFile:
+    """File attached to a local analysis."""
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.created = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+class LocalContainer:
+    """Project, subject, session or analysis stored as a folder."""
+
+    def __init__(self, client, rel_path):
+        self.client = client
+        self.path = os.path.join(client.root, rel_path)
+        self.id = rel_path.replace(os.sep, SEP)
+        self.label = os.path.basename(rel_path)
+
+        parts = rel_path.split(os.sep)
+        if len(parts) > 1 and parts[-2] == ANALYSES:
+            self.container_type = "analysis"
+            owner = parts[:-2]
+        else:
+            self.container_type = ("project", "subject", "session")[len(parts) - 1]
+            owner = parts[:-1]
+
+        lineage = [SEP.join(parts[:i]) for i in range(1, len(owner) + 1)]
+        self.parents = SimpleNamespace(
+            group=None,
+            project=lineage[0] if len(lineage) > 0 else None,
+            subject=lineage[1] if len(lineage) > 1 else None,
+            session=lineage[2] if len(lineage) > 2 else None,
+        )
+        self.parent = SimpleNamespace(
+            type=("project", "subject", "session")[len(owner) - 1] if owner else "group",
+            id=SEP.join(owner) if owner else None,
+        )
+        self.created = datetime.datetime.fromtimestamp(os.path.getmtime(self.path))
+
+    def _children(self, path):
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path) if name != ANALYSES and os.path.isdir(os.path.join(path, name)))
+
+    def sessions(self):
+        """Return the sessions below a project or subject."""
+        if self.container_type == "session":
+            return [self]
+        rel_path = self.id.replace(SEP, os.sep)
+        subjects = [rel_path] if self.container_type == "subject" else [
+            os.path.join(rel_path, name) for name in self._children(self.path)
+        ]
+        return [
+            LocalContainer(self.client, os.path.join(subject, name))
+            for subject in subjects
+            for name in self._children(os.path.join(self.client.root, subject))
+        ]
+
+    @property
+    def analyses(self):
+        rel_path = self.id.replace(SEP, os.sep)
+        folder = os.path.join(self.path, ANALYSES)
+        if not os.path.isdir(folder):
+            return []
+        return [LocalContainer(self.client, os.path.join(rel_path, ANALYSES, name)) for name in sorted(os.listdir(folder))]
+
+    @property
+    def files(self):
+        return [LocalFile(os.path.join(self.path, name)) for name in sorted(os.listdir(self.path))
+                if os.path.isfile(os.path.join(self.path, name))]
+
+    def download_file(self, name, dest_file):
+        """Copy a file of the container to dest_file."""
+        shutil.copyfile(os.path.join(self.path, name), dest_file)
+
+
+class LocalClient:
+    """Flywheel client answering from a folder tree.
+
+    Args:
+        root (str): folder holding the projects
+        latency (float): seconds each get takes, as a request to the platform would
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = str(root)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get(self, id_):
+        """Return the container with this id."""
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        rel_path = id_.replace(SEP, os.sep)
+        if not os.path.isdir(os.path.join(self.root, rel_path)):
+            raise KeyError("No container %s in %s" % (id_, self.root))
+        return LocalContainer(self, rel_path)
+
+    def add_container(self, container_type, label, parent_id=None):
+        """Create a project (no parent), subject or session."""
+        rel_path = os.path.join(parent_id.replace(SEP, os.sep), label) if parent_id else label
+        os.makedirs(os.path.join(self.root, rel_path), exist_ok=True)
+        container = LocalContainer(self, rel_path)
+        assert container.container_type == container_type, container.container_type
+        return container
+
+    def add_analysis(self, parent_id, label, files=()):
+        """Create an analysis below a container, with copies of files."""
+        rel_path = os.path.join(parent_id.replace(SEP, os.sep), ANALYSES, label)
+        os.makedirs(os.path.join(self.root, rel_path), exist_ok=True)
+        for path in files:
+            shutil.copy(path, os.path.join(self.root, rel_path))
+        return LocalContainer(self, rel_path)
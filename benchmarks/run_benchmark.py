@@ -0,0 +1,251 @@
+"""End-to-end benchmark of the gear's own overhead, with a stub tedana.
+
+A synthetic fmriprep session is generated, and run.execute is called with a fake
+GearToolkitContext and a Flywheel client backed by a local folder tree
+(benchmarks/local_client.py), so everything runs offline. tedana is
+replaced by benchmarks/stub_tedana.py, so the measured times are those of the gear
+stages (extract, discover, launch, report move, html zip, final archive).
+
+Examples:
+    $ python benchmarks/run_benchmark.py --tasks 6 --echoes 4 --volumes 200
+    $ python benchmarks/run_benchmark.py --stub-seconds 2 --workers 3 --json bench.json
+    $ python benchmarks/run_benchmark.py --sessions 8 --tasks 2
+    $ python benchmarks/run_benchmark.py --latency 0.2
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+from benchmarks import fake_slurm  # noqa: E402
+from benchmarks.local_client import LocalClient  # noqa: E402
+from benchmarks.synthetic_session import make_session_zip  # noqa: E402
+
+# benchmark stage -> gear metrics phase
+STAGES = [
+    ("download", "download"),
+    ("extract", "extract"),
+    ("discover", "discover"),
+    ("preflight", "preflight"),
+    ("staging", "stage"),
+    ("launch", "tedana"),
+    ("report move", "report-move"),
+    ("compact", "compact"),
+    ("html zip", "zip-htmls"),
+    ("html flatten", "flatten-htmls"),
+    ("final archive", "archive"),
+]
+
+
+class FakeMetadata:
+    """Records what the gear would write to .metadata.json."""
+
+    def __init__(self):
+        self.updates = []
+
+    def update_container(self, container_type, deep=True, **kwargs):
+        self.updates.append((container_type, kwargs))
+
+
+class FakeContext:
+    """Offline stand-in for GearToolkitContext."""
+
+    def __init__(self, root, config, inputs, client, destination_id):
+        self.config = config
+        self.output_dir = Path(root) / "output"
+        self.work_dir = Path(root) / "work"
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.destination = {"id": destination_id, "type": "analysis"}
+        self.client = client
+        self.metadata = FakeMetadata()
+        self._inputs = inputs
+
+    def get_input_path(self, name):
+        return self._inputs.get(name)
+
+    def get_input_file_object(self, name):
+        return {"info": {}} if name in self._inputs else None
+
+
+def session_project(root, latency=0.0, sub="01", ses="01"):
+    """Create a local project with one session and a tedana analysis on it.
+
+    Returns:
+        client (LocalClient): client for the project
+        destination_id (str): tedana analysis at the session level
+    """
+    client = LocalClient(Path(root) / "flywheel", latency=latency)
+    project = client.add_container("project", "benchmark")
+    subject = client.add_container("subject", sub, project.id)
+    session = client.add_container("session", ses, subject.id)
+    return client, client.add_analysis(session.id, "tedana").id
+
+
+def gear_config(**overrides):
+    """Return a gear config with the manifest defaults."""
+    with open(REPO / "manifest.json") as f:
+        manifest = json.load(f)
+    config = {key: spec.get("default") for key, spec in manifest["config"].items()}
+    config.update(overrides)
+    return config
+
+
+def stub_path(root):
+    """Put the stub tedana on the PATH as "tedana"."""
+    bin_dir = Path(root) / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    tedana = bin_dir / "tedana"
+    tedana.write_text(f"#!/bin/sh\nexec {sys.executable} {REPO / 'benchmarks' / 'stub_tedana.py'} \"$@\"\n")
+    tedana.chmod(0o755)
+    os.environ["PATH"] = str(bin_dir) + os.pathsep + os.environ["PATH"]
+
+
+def batch_project(root, args):
+    """Create a local project with one fmriprep analysis per session.
+
+    Returns:
+        client (LocalClient): client for the project
+        destination_id (str): tedana analysis at the project level
+    """
+    client = LocalClient(Path(root) / "flywheel", latency=args.latency)
+    project = client.add_container("project", "benchmark")
+    for i in range(args.sessions):
+        subject = client.add_container("subject", "%02d" % (i + 1), project.id)
+        session = client.add_container("session", "01", subject.id)
+        zip_path = Path(root) / ("fmriprep_%02d.zip" % i)
+        make_session_zip(str(zip_path), args.tasks, args.echoes, tuple(args.matrix), args.volumes,
+                         sub=subject.label, ses=session.label, seed=i)
+        client.add_analysis(session.id, "fmriprep", [zip_path])
+        zip_path.unlink()
+    return client, client.add_analysis(project.id, "tedana").id
+
+
+def run_benchmark(args) -> dict:
+    """Generate a session, run the gear on it and return the stage timings."""
+    from run import execute  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory(prefix="tedana-bench-") as root:
+        start = time.monotonic()
+        if args.sessions:
+            client, destination_id = batch_project(root, args)
+            inputs = {}
+        else:
+            zip_path = Path(root) / "input" / "fmriprep_zip" / "fmriprep_session.zip"
+            zip_path.parent.mkdir(parents=True)
+            make_session_zip(str(zip_path), args.tasks, args.echoes, tuple(args.matrix), args.volumes)
+            client, destination_id = session_project(root, args.latency)
+            inputs = {"fmriprep_zip": str(zip_path)}
+        generate_seconds = time.monotonic() - start
+
+        stub_path(root)
+        os.environ["TEDANA_STUB_SECONDS"] = str(args.stub_seconds)
+        if args.slurm:
+            from fw_gear_tedana.engine import SlurmArrayEngine  # pylint: disable=import-outside-toplevel
+
+            fake_slurm.install(Path(root) / "bin")
+            os.environ["FAKE_SLURM_DIR"] = str(Path(root) / "fake-slurm")
+            fake_slurm.STATE_DIR = Path(root) / "fake-slurm"
+            SlurmArrayEngine.poll_seconds = 0.2
+            SlurmArrayEngine.batch_seconds = 0.5
+
+        config = gear_config(
+            **{
+                "gear-n-workers": args.workers,
+                "gear-tedana-engine": "slurm-array" if args.slurm else "command-line",
+                "gear-writable-dir": root,
+                "explicit-mask": args.mask,
+                "gear-stage-uncompressed": args.stage,
+                "gear-archive-mode": args.archive_mode,
+                "gear-report-format": args.report_format,
+                "gear-dry-run": args.dry_run,
+                "gear-compact-outputs": args.compact,
+                "gear-eager-cleanup": not args.keep_scratch,
+            }
+        )
+        context = FakeContext(root, config, inputs, client, destination_id)
+
+        start = time.monotonic()
+        return_code = execute(context)
+        total_seconds = time.monotonic() - start
+
+        with open(context.output_dir / f"tedana_metrics_{destination_id}.json") as f:
+            metrics = json.load(f)
+        plan = None
+        if args.dry_run:
+            with open(context.output_dir / f"tedana_plan_{destination_id}.json") as f:
+                plan = json.load(f)
+
+    result = {
+        "return_code": return_code,
+        "parameters": vars(args),
+        "generate_seconds": round(generate_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "client_requests": client.requests,
+        "peak_disk_bytes": metrics.get("peak_disk_bytes", 0),
+        "stages": {},
+    }
+    for stage, phase in STAGES:
+        seconds = metrics["session"].get(phase, {}).get("seconds", 0.0)
+        if phase == "tedana":
+            # time spent in the stub itself is not gear overhead
+            seconds = max(0.0, seconds - args.stub_seconds * args.tasks * max(1, args.sessions))
+        result["stages"][stage] = round(seconds, 3)
+    result["metrics"] = metrics
+    if plan:
+        result["plan"] = plan
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=2)
+    parser.add_argument("--echoes", type=int, default=3)
+    parser.add_argument("--matrix", type=int, nargs=3, default=[32, 32, 24])
+    parser.add_argument("--volumes", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=0,
+                        help="run in batch mode on a local project with this many sessions")
+    parser.add_argument("--workers", type=int, default=0, help="gear-n-workers (0: allocated cpus)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds each Flywheel request takes (simulated round trip)")
+    parser.add_argument("--stub-seconds", type=float, default=0.0, help="seconds each stub tedana run sleeps")
+    parser.add_argument("--mask", action="store_true", help="use explicit-mask")
+    parser.add_argument("--slurm", action="store_true", help="use the slurm-array engine with a fake SLURM")
+    parser.add_argument("--archive-mode", default="session", choices=["session", "per-task"])
+    parser.add_argument("--report-format", default="html-zip", choices=["html-zip", "standalone"])
+    parser.add_argument("--compact", default="off", choices=["off", "gzip", "uncompressed"],
+                        help="gear-compact-outputs")
+    parser.add_argument("--stage", action="store_true", help="use gear-stage-uncompressed")
+    parser.add_argument("--dry-run", action="store_true", help="use gear-dry-run and keep the execution plan")
+    parser.add_argument("--keep-scratch", action="store_true", help="disable gear-eager-cleanup")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    result = run_benchmark(args)
+
+    print(f"{'stage':<16}{'seconds':>10}")
+    for stage, seconds in result["stages"].items():
+        print(f"{stage:<16}{seconds:>10.3f}")
+    print(f"{'total':<16}{result['total_seconds']:>10.3f}")
+    print(f"{'requests':<16}{result['client_requests']:>10d}")
+    print(f"{'peak disk MB':<16}{result['peak_disk_bytes'] / 1e6:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    sys.exit(result["return_code"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Benchmark of the gear's cold start: time from process start until execute() is called.
+
+A gear folder with a manifest, a config.json and an input file is created, and a fresh
+python process runs what run.py runs before execute() (imports, config.json, scratch
+estimate, GearToolkitContext), so every measurement includes interpreter startup and
+cold imports. The median over the repetitions is compared with a budget, and the
+script exits with an error when it is over.
+
+Examples:
+    $ python benchmarks/startup_benchmark.py
+    $ python benchmarks/startup_benchmark.py --repeat 10 --budget 1.5 --json startup.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+from benchmarks.run_benchmark import gear_config  # noqa: E402
+
+DEFAULT_BUDGET = 2.0
+
+# the start of run.py's __main__, up to the execute() call
+CHILD = """
+import time
+marks = {"python": time.time()}
+import json, logging, sys
+sys.path.insert(0, %(repo)r)
+import run
+from utils.singularity import estimate_scratch
+marks["gear imports"] = time.time()
+with open("config.json") as f:
+    config_json = json.load(f)
+logging.basicConfig(level=logging.WARNING)
+estimate_scratch(inp["location"]["path"] for inp in config_json["inputs"].values() if inp["base"] == "file")
+import flywheel_gear_toolkit
+with flywheel_gear_toolkit.GearToolkitContext() as gear_context:
+    gear_context.init_logging()
+    marks["context"] = time.time()
+print(json.dumps(marks))
+"""
+
+
+def gear_dir(root) -> Path:
+    """Create a gear folder (manifest, config.json, one input) below root."""
+    path = Path(root) / "v0"
+    input_file = path / "input" / "fmriprep_zip" / "fmriprep_session.zip"
+    input_file.parent.mkdir(parents=True)
+    input_file.write_bytes(b"\0" * 1024)
+    (path / "manifest.json").write_bytes((REPO / "manifest.json").read_bytes())
+    config_json = {
+        "config": gear_config(**{"gear-writable-dir": str(root)}),
+        "inputs": {
+            "fmriprep_zip": {
+                "base": "file",
+                "location": {"name": input_file.name, "path": str(input_file)},
+                "object": {"info": {}},
+            }
+        },
+        "destination": {"id": "startup-analysis", "type": "analysis"},
+    }
+    with open(path / "config.json", "w") as f:
+        json.dump(config_json, f)
+    return path
+
+
+def measure(path) -> dict:
+    """Run one cold start in path and return the seconds spent in each step."""
+    start = time.time()
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD % {"repo": str(REPO)}], cwd=path, check=True, capture_output=True, text=True
+    ).stdout
+    marks = json.loads(out.strip().splitlines()[-1])
+    steps = {}
+    previous = start
+    for step, mark in marks.items():
+        steps[step] = mark - previous
+        previous = mark
+    steps["total"] = marks["context"] - start
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="maximum median seconds until execute() (default %(default)s)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tedana-startup-") as root:
+        path = gear_dir(root)
+        runs = [measure(path) for _ in range(args.repeat)]
+
+    result = {
+        "parameters": vars(args),
+        "python": sys.version.split()[0],
+        "median": {step: round(statistics.median(r[step] for r in runs), 3) for step in runs[0]},
+        "runs": runs,
+    }
+    result["over_budget"] = result["median"]["total"] > args.budget
+
+    print(f"{'step':<16}{'seconds':>10}")
+    for step, seconds in result["median"].items():
+        print(f"{step:<16}{seconds:>10.3f}")
+    print(f"{'budget':<16}{args.budget:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if result["over_budget"]:
+        print(f"Time to execute() is over the budget of {args.budget} s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Stand-in for the tedana executable, used to measure the gear's own overhead.
+
+It accepts tedana's command line, optionally sleeps and writes a set of outputs with
+the same names and layout as tedana (prefixed maps, report, figures, logs); like
+tedana, it writes the 3D maps (T2starmap, S0map) as float64. Its behavior is configured through environment variables:
+
+    TEDANA_STUB_SECONDS   seconds to sleep, standing in for tedana's compute (0)
+    TEDANA_STUB_MAPS      number of extra component maps to write (4)
+    TEDANA_STUB_FIGURES   number of report figures to write (10)
+    TEDANA_STUB_EXIT      exit code to return (0)
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tedana")
+    parser.add_argument("-d", dest="data", nargs="+", required=True)
+    parser.add_argument("-e", dest="tes", nargs="+", type=float, required=True)
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--mask")
+    args, _ = parser.parse_known_args(argv)
+
+    env = os.environ
+    time.sleep(float(env.get("TEDANA_STUB_SECONDS", 0)))
+    if int(env.get("TEDANA_STUB_EXIT", 0)):
+        print("stub tedana failing on request", file=sys.stderr)
+        return int(env["TEDANA_STUB_EXIT"])
+
+    out = args.out_dir
+    prefix = args.prefix + "_" if args.prefix else ""
+    os.makedirs(os.path.join(out, "figures"), exist_ok=True)
+
+    first = nib.load(args.data[0])
+    for desc in ["T2starmap", "S0map"]:
+        data = np.asanyarray(first.dataobj)[..., 0].astype(np.float64) / 7
+        nib.save(nib.Nifti1Image(data, first.affine), os.path.join(out, f"{prefix}desc-{desc}.nii.gz"))
+
+    for desc in ["optcom", "denoised"] + [
+        f"ICA{i}" for i in range(int(env.get("TEDANA_STUB_MAPS", 4)))
+    ]:
+        target = os.path.join(out, f"{prefix}desc-{desc}_bold.nii.gz")
+        if args.data[0].endswith(".gz"):
+            shutil.copyfile(args.data[0], target)
+        else:
+            with open(args.data[0], "rb") as fin, gzip.open(target, "wb", compresslevel=1) as fout:
+                shutil.copyfileobj(fin, fout)
+    with open(os.path.join(out, f"{prefix}desc-tedana_metrics.tsv"), "w") as f:
+        f.write("\n".join("\t".join(str(i * j) for j in range(30)) for i in range(200)))
+
+    figures = []
+    for i in range(int(env.get("TEDANA_STUB_FIGURES", 10))):
+        name = f"comp_{i:03d}.png" if i % 2 else f"carpet_{i:03d}.svg"
+        with open(os.path.join(out, "figures", name), "wb") as f:
+            f.write(os.urandom(20000) if name.endswith(".png") else b"<svg xmlns='http://www.w3.org/2000/svg'/>" * 500)
+        figures.append(name)
+
+    with open(os.path.join(out, "tedana_report.html"), "w") as f:
+        f.write("<html><body>" + "".join(f'<img src="./figures/{n}">' for n in figures) + "</body></html>")
+    with open(os.path.join(out, "report.txt"), "w") as f:
+        f.write("TE-dependence analysis was performed on input data (stub).\n")
+    with open(os.path.join(out, time.strftime("tedana_%Y-%m-%dT%H%M%S.tsv")), "w") as f:
+        f.write("stub tedana log\n")
+    with open(os.path.join(out, "dataset_description.json"), "w") as f:
+        json.dump({"Name": "tedana Outputs", "BIDSVersion": "1.5.0"}, f)
+
+    print(f"stub tedana wrote outputs for {args.prefix} to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
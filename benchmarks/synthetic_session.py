@@ -0,0 +1,103 @@
+"""Generate a synthetic fmriprep-style multi-echo session archive.
+
+The archive mimics the output of the fmriprep gear run with "--me-output-echos":
+per-echo preprocessed bold images with JSON sidecars (EchoTime), a brain mask per
+task, plus anatomical derivatives and figures that tedana does not need.
+
+Examples:
+    $ python benchmarks/synthetic_session.py session.zip --tasks 4 --echoes 3
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import zipfile
+
+import nibabel as nib
+import numpy as np
+
+ANALYSIS_ID = "fmriprep-analysis"
+ECHO_TIMES = [0.0142, 0.0389, 0.0636, 0.0883, 0.113]
+
+
+def make_session_zip(
+    dest_zip,
+    n_tasks=2,
+    n_echoes=3,
+    matrix=(32, 32, 24),
+    n_volumes=50,
+    sub="01",
+    ses="01",
+    analysis_id=ANALYSIS_ID,
+    seed=0,
+):
+    """Write a synthetic fmriprep session archive.
+
+    Args:
+        dest_zip (str): archive to create
+        n_tasks (int): number of multi-echo runs
+        n_echoes (int): number of echoes per run
+        matrix (tuple): spatial dimensions of the bold images
+        n_volumes (int): number of volumes per run
+        sub (str): subject label
+        ses (str): session label
+        analysis_id (str): top level folder of the archive
+        seed (int): random seed
+
+    Returns:
+        members (list of str): names of the archive members
+    """
+    rng = np.random.default_rng(seed)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    session = f"{analysis_id}/fmriprep/sub-{sub}/ses-{ses}"
+
+    with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(dest_zip, "w", zipfile.ZIP_DEFLATED) as zf:
+
+        def add_image(data, arcname, zooms):
+            img = nib.Nifti1Image(data, affine)
+            img.header.set_zooms(zooms)
+            path = os.path.join(tmp, os.path.basename(arcname))
+            nib.save(img, path)
+            zf.write(path, arcname)
+            os.remove(path)
+
+        mask = np.zeros(matrix, dtype=np.uint8)
+        mask[2:-2, 2:-2, 2:-2] = 1
+        add_image(rng.random(matrix, dtype=np.float32), f"{session}/anat/sub-{sub}_ses-{ses}_desc-preproc_T1w.nii.gz",
+                  (1.0, 1.0, 1.0))
+        zf.writestr(f"{analysis_id}/fmriprep/sub-{sub}/figures/sub-{sub}_ses-{ses}_desc-summary_T1w.svg",
+                    "<svg xmlns='http://www.w3.org/2000/svg'/>" * 1000)
+
+        for task in range(1, n_tasks + 1):
+            prefix = f"sub-{sub}_ses-{ses}_task-rest_run-{task}"
+            signal = 1000 + 100 * rng.standard_normal(matrix + (n_volumes,), dtype=np.float32)
+            for echo in range(1, n_echoes + 1):
+                echo_time = ECHO_TIMES[(echo - 1) % len(ECHO_TIMES)]
+                data = (signal * np.exp(-echo_time / 0.04)).astype(np.float32)
+                name = f"{session}/func/{prefix}_echo-{echo}_desc-preproc_bold"
+                add_image(data, name + ".nii.gz", (3.0, 3.0, 3.0, 2.0))
+                zf.writestr(name + ".json", json.dumps({"EchoTime": echo_time, "RepetitionTime": 2.0}))
+            add_image(mask, f"{session}/func/{prefix}_desc-brain_mask.nii.gz", (3.0, 3.0, 3.0))
+            add_image(signal[..., 0], f"{session}/func/{prefix}_desc-preproc_bold_boldref.nii.gz",
+                      (3.0, 3.0, 3.0))
+            zf.writestr(f"{session}/func/{prefix}_desc-confounds_timeseries.tsv",
+                        "\n".join("\t".join("0.0" for _ in range(20)) for _ in range(n_volumes)))
+
+        return zf.namelist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dest_zip")
+    parser.add_argument("--tasks", type=int, default=2)
+    parser.add_argument("--echoes", type=int, default=3)
+    parser.add_argument("--matrix", type=int, nargs=3, default=[32, 32, 24])
+    parser.add_argument("--volumes", type=int, default=50)
+    args = parser.parse_args()
+    members = make_session_zip(args.dest_zip, args.tasks, args.echoes, tuple(args.matrix), args.volumes)
+    print(f"Wrote {args.dest_zip} ({len(members)} members)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Batch mode: run tedana for every session with an fmriprep analysis below a project or subject.
+
+The fmriprep archives of the sessions are downloaded and extracted a few at a time,
+then the tasks of all sessions are scheduled on one shared worker pool. Each session
+keeps its own work folder, progress record and output archive.
+"""
+
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Tuple
+
+from fw_gear_tedana.checkpoint import SESSION, STATE_FILENAME, Checkpoint
+from fw_gear_tedana.main import archive_outputs, fmriprep_task_specs, plan_tasks, prepare, run_task_pool
+from fw_gear_tedana.parser import unzip_file
+
+log = logging.getLogger(__name__)
+
+# destinations processed in batch mode
+BATCH_PARENTS = ("project", "subject")
+
+# session archives written by the fmriprep gears (not their html reports)
+FMRIPREP_ZIP = re.compile(r"fmriprep.*(?<!\.html)\.zip$")
+
+DEFAULT_DOWNLOADS = 4
+
+
+def fmriprep_analysis(session):
+    """Return the most recent analysis of a session with an fmriprep archive.
+
+    Args:
+        session: Flywheel session, with its analyses
+
+    Returns:
+        analysis, file_name: the analysis and the name of its archive, or None
+    """
+    found = None
+    for analysis in session.analyses or []:
+        for file_entry in analysis.files or []:
+            if FMRIPREP_ZIP.search(file_entry.name) and (found is None or analysis.created > found[0].created):
+                found = (analysis, file_entry.name)
+    return found
+
+
+def find_sessions(gear_options: dict) -> List[dict]:
+    """List the sessions below the batch destination that have an fmriprep analysis.
+
+    Args:
+        gear_options (dict): gear options, with "batch-parent-id"
+
+    Returns:
+        sessions (list of dict): id, sid, sesid, analysis and file of each session
+    """
+    containers = gear_options["containers"]
+    parent = containers.get(gear_options["batch-parent-id"])
+
+    # sessions returned by a listing do not include their analyses, so they are
+    # fetched again; all sessions, then the subjects of the selected ones, concurrently
+    listed = containers.get_many(s.id for s in parent.sessions())
+
+    found = {}
+    for session in listed.values():
+        found[session.id] = fmriprep_analysis(session)
+        if not found[session.id]:
+            log.info("No fmriprep analysis found for session %s, skipping", session.label)
+    containers.get_many(listed[id_].parents.subject for id_ in found if found[id_])
+
+    sessions = []
+    for session in listed.values():
+        if found[session.id]:
+            sessions.append({
+                "id": session.id,
+                "sid": containers.label(session.parents.subject),
+                "sesid": session.label,
+                "analysis": found[session.id][0],
+                "file": found[session.id][1],
+            })
+
+    log.info("Found %d sessions with an fmriprep analysis below %s %s",
+             len(sessions), gear_options["batch-parent-type"], parent.label)
+    return sessions
+
+
+def session_options(gear_options: dict, app_options: dict, session: dict) -> Tuple[dict, dict]:
+    """Derive the options of one session from the batch options.
+
+    Each session works in its own folder below the work directory, with its own
+    progress record, and its archive is named after its subject and session.
+    """
+    work_dir = Path(gear_options["work-dir"]) / session["id"]
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    session_gear_options = dict(gear_options)
+    session_gear_options["work-dir"] = work_dir
+    if gear_options["resume"]:
+        session_gear_options["checkpoint"] = Checkpoint(str(work_dir / STATE_FILENAME))
+    else:
+        session_gear_options["checkpoint"] = Checkpoint()
+
+    session_app_options = dict(app_options)
+    session_app_options.update({
+        "inputtype": "fmriprep",
+        "work-dir": work_dir,
+        "sid": session["sid"],
+        "sesid": session["sesid"],
+        "archive-label": session["sid"] + "_" + session["sesid"],
+    })
+    return session_gear_options, session_app_options
+
+
+def fetch_session(gear_options: dict, app_options: dict, session: dict):
+    """Download and extract the fmriprep archive of one session."""
+    checkpoint = gear_options["checkpoint"]
+    metrics = gear_options["metrics"]
+    label = app_options["archive-label"]
+
+    if checkpoint.reached(SESSION, "extracted"):
+        analysis_id = checkpoint.get(SESSION, "analysis_id")
+        log.info("fmriprep archive of %s was already extracted, skipping", label)
+    else:
+        zip_path = os.path.join(gear_options["work-dir"], session["file"])
+        with metrics.phase("download", task=label):
+            session["analysis"].download_file(session["file"], zip_path)
+        with metrics.phase("extract", task=label):
+            analysis_id = unzip_file(gear_options, zip_path, explicit_mask=app_options["explicit-mask"])
+        os.remove(zip_path)
+        checkpoint.set(SESSION, "extracted", analysis_id=analysis_id)
+
+    gear_options["fmriprep-dir"] = os.path.join(gear_options["work-dir"], analysis_id, "fmriprep")
+
+
+def run_batch(gear_options: dict, app_options: dict) -> int:
+    """Run tedana for all sessions with an fmriprep analysis below the destination.
+
+    Arguments:
+        gear_options: dict with gear-specific options
+        app_options: dict with options for the BIDS-App
+
+    Returns:
+        run_error: 0 if every session was processed, 1 otherwise
+    """
+    metrics = gear_options["metrics"]
+
+    with metrics.phase("discover"):
+        sessions = find_sessions(gear_options)
+    if not sessions:
+        log.error("No session with an fmriprep analysis found")
+        return 1
+
+    options = {s["id"]: session_options(gear_options, app_options, s) for s in sessions}
+    labels = {s["id"]: options[s["id"]][1]["archive-label"] for s in sessions}
+    failed = {}
+
+    # archives are fetched a few at a time, to bound bandwidth and disk use
+    n_downloads = gear_options.get("batch-downloads") or DEFAULT_DOWNLOADS
+    with ThreadPoolExecutor(max_workers=n_downloads) as pool:
+        futures = {pool.submit(fetch_session, *options[s["id"]], s): s["id"] for s in sessions}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                log.error("Could not fetch the fmriprep archive of %s: %s", labels[futures[future]], exc)
+                failed[futures[future]] = exc
+
+    jobs = []
+    session_of_task = {}
+    for session in sessions:
+        if session["id"] in failed:
+            continue
+        session_gear_options, session_app_options = options[session["id"]]
+        errors, _ = prepare(session_gear_options, session_app_options)
+        if errors:
+            failed[session["id"]] = errors[0]
+            continue
+        with metrics.phase("discover", task=labels[session["id"]]):
+            task_specs = fmriprep_task_specs(session_gear_options, session_app_options)
+        for spec in task_specs:
+            if session_gear_options["checkpoint"].stage(spec["prefix"]) is None:
+                session_gear_options["checkpoint"].set(spec["prefix"], "extracted")
+            jobs.append((session_gear_options, spec))
+            session_of_task[spec["prefix"]] = session["id"]
+
+    if jobs and gear_options["dry-run"]:
+        plan_tasks(gear_options, jobs)
+    elif jobs:
+        for prefix, exc in run_task_pool(gear_options, jobs).items():
+            failed.setdefault(session_of_task[prefix], exc)
+
+    if not gear_options["dry-run"]:
+        for session in sessions:
+            if session["id"] not in failed:
+                archive_outputs(*options[session["id"]])
+
+    for session_id, exc in failed.items():
+        log.error("Session %s failed: %s", labels[session_id], exc)
+    log.info("Processed %d of %d sessions", len(sessions) - len(failed), len(sessions))
+
+    if failed:
+        return 1
+
+    if gear_options["resume"] and not gear_options["dry-run"]:
+        log.info("Run complete, removing resume folder %s", gear_options["work-dir"])
+        shutil.rmtree(gear_options["work-dir"], ignore_errors=True)
+    return 0
@@ -0,0 +1,158 @@
+"""Index of the BIDS entities of an fmriprep "func" folder.
+
+The folder is scanned once with os.scandir and every file name is parsed into a
+BidsFile record. Lookups (tasks, echoes, sidecars, masks) are then answered from
+that table without touching the filesystem again.
+"""
+
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+log = logging.getLogger(__name__)
+
+# entities following these ones no longer identify the acquisition
+NON_PREFIX_ENTITIES = ("echo", "part", "space", "res", "den", "desc")
+
+
+class BidsFile(NamedTuple):
+    """Parsed name of one file in the index."""
+
+    path: str
+    sub: Optional[str]
+    ses: Optional[str]
+    task: Optional[str]
+    acq: Optional[str]
+    run: Optional[str]
+    echo: Optional[str]
+    desc: Optional[str]
+    suffix: str
+    extension: str
+    prefix: str  # entities identifying the acquisition, e.g. sub-01_ses-01_task-rest_run-1
+
+
+def parse_bids_name(path) -> Optional[BidsFile]:
+    """Parse the entities, suffix and extension of a BIDS file name.
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        BidsFile, or None if the name does not follow the BIDS naming scheme
+    """
+    name = os.path.basename(path)
+    stem, dot, extension = name.partition(".")
+    parts = stem.split("_")
+    if not dot or len(parts) < 2:
+        return None
+
+    entities: Dict[str, str] = {}
+    prefix = []
+    in_prefix = True
+    for part in parts[:-1]:
+        key, sep, value = part.partition("-")
+        if not sep:
+            return None
+        if key in NON_PREFIX_ENTITIES:
+            in_prefix = False
+        if in_prefix:
+            prefix.append(part)
+        entities[key] = value
+
+    return BidsFile(
+        path=path,
+        sub=entities.get("sub"),
+        ses=entities.get("ses"),
+        task=entities.get("task"),
+        acq=entities.get("acq"),
+        run=entities.get("run"),
+        echo=entities.get("echo"),
+        desc=entities.get("desc"),
+        suffix=parts[-1],
+        extension="." + extension,
+        prefix="_".join(prefix),
+    )
+
+
+def has_prefix(name, prefix) -> bool:
+    """Return whether a file or folder name belongs to the acquisition with this prefix.
+
+    The name must start with the prefix and continue with a non-identifying part:
+    "sub-01_task-rest_desc-optcom_bold.nii.gz" and "sub-01_task-rest_report" belong to
+    "sub-01_task-rest", "sub-01_task-rest_acq-mb_bold.nii.gz" does not.
+    """
+    if not name.startswith(prefix + "_"):
+        return False
+    following = name[len(prefix) + 1:].partition(".")[0].split("_")[0]
+    key, sep, _ = following.partition("-")
+    return not sep or key in NON_PREFIX_ENTITIES
+
+
+def _echo_number(echo):
+    return (0, int(echo)) if echo.isdigit() else (1, echo)
+
+
+class FuncIndex:
+    """Single-pass index of an fmriprep "func" folder.
+
+    Args:
+        func_dir (str): folder to index
+    """
+
+    def __init__(self, func_dir):
+        self.func_dir = func_dir
+        self.files: List[BidsFile] = []
+        self._by_name: Dict[str, BidsFile] = {}
+
+        try:
+            with os.scandir(func_dir) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    bids_file = parse_bids_name(entry.path)
+                    if bids_file:
+                        self.files.append(bids_file)
+                        self._by_name[entry.name] = bids_file
+        except FileNotFoundError:
+            log.warning("No func folder at %s", func_dir)
+
+        log.debug("Indexed %d files in %s", len(self.files), func_dir)
+
+    @staticmethod
+    def task_key(bids_file: BidsFile) -> str:
+        """Label used for a task: the acquisition prefix without subject and session."""
+        return "_".join(p for p in bids_file.prefix.split("_") if not p.startswith(("sub-", "ses-")))
+
+    def tasks(self) -> List[str]:
+        """Return the tasks with multi-echo preprocessed bold images."""
+        return sorted({self.task_key(f) for f in self._echo_files()})
+
+    def echoes(self, task) -> List[str]:
+        """Return the preprocessed echoes of a task, ordered by echo number."""
+        files = [f for f in self._echo_files() if self.task_key(f) == task]
+        return [f.path for f in sorted(files, key=lambda f: _echo_number(f.echo))]
+
+    def sidecar(self, path) -> Optional[str]:
+        """Return the JSON sidecar of an indexed file, if there is one."""
+        bids_file = self._by_name.get(os.path.basename(path))
+        if bids_file is None:
+            return None
+        name = os.path.basename(path)[: -len(bids_file.extension)] + ".json"
+        return self._by_name[name].path if name in self._by_name else None
+
+    def mask(self, prefix) -> Optional[str]:
+        """Return the brain mask of an acquisition, preferring the native (no space) one."""
+        masks = [
+            f
+            for f in self.files
+            if f.prefix == prefix and f.desc == "brain" and f.suffix == "mask" and f.extension == ".nii.gz"
+        ]
+        masks.sort(key=lambda f: ("_space-" in os.path.basename(f.path), f.path))
+        return masks[0].path if masks else None
+
+    def _echo_files(self):
+        return (
+            f
+            for f in self.files
+            if f.echo is not None and f.desc == "preproc" and f.suffix == "bold" and f.extension == ".nii.gz"
+        )
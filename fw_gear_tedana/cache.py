@@ -0,0 +1,195 @@
+"""Content-addressed cache of tedana results.
+
+A run is identified by the content of its echo files and mask, its echo times, the
+normalized tedana arguments and the tedana version. The outputs of a successful run
+are stored under that key, and a later run with the same key restores them instead
+of running tedana again. Entries are evicted least-recently-used first once the
+cache grows beyond its size limit.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+CACHE_DIRNAME = "tedana-cache"
+ENTRY_INFO = "cache.json"
+LAST_USED = ".last-used"
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# arguments that hold paths; their content is part of the key instead
+PATH_ARGS = ["d", "e", "mask", "out-dir"]
+
+
+def file_digest(path) -> str:
+    """Return the sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalized_args(arg_options: dict) -> dict:
+    """Return the tedana arguments of a run as they enter the key.
+
+    Path arguments are left out (their content is hashed instead), and the free-form
+    "command-line-args" are split like a shell would, so spacing does not matter.
+    """
+    args = {k: v for k, v in sorted(arg_options.items()) if k not in PATH_ARGS}
+    args["command-line-args"] = shlex.split(args.get("command-line-args") or "")
+    return args
+
+
+def tedana_version() -> str:
+    """Return the installed tedana version."""
+    try:
+        return metadata.version("tedana")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _tree_size(path) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return size
+
+
+class ResultCache:
+    """Cache of tedana output folders below a root folder.
+
+    Args:
+        root (str): cache folder
+        max_bytes (int): size limit of the cache
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, gear_options: dict):
+        """Create the cache configured by "gear-cache-size", or None if it is disabled."""
+        size_gb = gear_options.get("cache-size") or 0
+        if size_gb <= 0 or gear_options["dry-run"] or not gear_options.get("writable-dir"):
+            return None
+        root = os.path.join(gear_options["writable-dir"], CACHE_DIRNAME)
+        try:
+            return cls(root, int(size_gb * 1024 ** 3))
+        except OSError as e:
+            log.warning("Result cache disabled, cannot create %s: %s", root, e)
+            return None
+
+    def key(self, spec: dict) -> str:
+        """Compute the cache key of a tedana run.
+
+        Args:
+            spec (dict): tedana run, see fmriprep_task_spec
+
+        Returns:
+            key (str): hex digest identifying the run
+        """
+        arg_options = spec["arg_options"]
+        inputs = list(spec["echo_files"])
+        if arg_options.get("mask"):
+            inputs.append(arg_options["mask"])
+        with ThreadPoolExecutor(max_workers=len(inputs)) as pool:
+            digests = list(pool.map(file_digest, inputs))
+
+        payload = {
+            "version": CACHE_VERSION,
+            "tedana": tedana_version(),
+            "echoes": digests[: len(spec["echo_files"])],
+            "echo_times": spec["echo_times"],
+            "mask": digests[len(spec["echo_files"]):],
+            "args": normalized_args(arg_options),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive=False):
+        with open(os.path.join(self.root, ".lock"), "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def restore(self, key, out_dir) -> bool:
+        """Copy the cached outputs of a run into out_dir.
+
+        Returns:
+            hit (bool): True if the run was found in the cache
+        """
+        entry = os.path.join(self.root, key)
+        with self._lock():
+            if not os.path.exists(os.path.join(entry, ENTRY_INFO)):
+                return False
+            shutil.copytree(
+                entry, out_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns(ENTRY_INFO, LAST_USED)
+            )
+            with open(os.path.join(entry, LAST_USED), "w"):
+                pass
+        log.info("Restored cached tedana outputs %s to %s", key, out_dir)
+        return True
+
+    def store(self, key, out_dir, prefix=""):
+        """Add the outputs of a successful run to the cache, then evict old entries."""
+        entry = os.path.join(self.root, key)
+        tmp_entry = os.path.join(self.root, ".tmp-%s-%d" % (key, os.getpid()))
+        try:
+            shutil.copytree(out_dir, tmp_entry, dirs_exist_ok=True)
+            with open(os.path.join(tmp_entry, ENTRY_INFO), "w") as f:
+                json.dump({"prefix": prefix, "created": time.time(), "bytes": _tree_size(tmp_entry)}, f)
+            with open(os.path.join(tmp_entry, LAST_USED), "w"):
+                pass
+            with self._lock(exclusive=True):
+                if os.path.exists(entry):
+                    shutil.rmtree(tmp_entry)
+                else:
+                    os.rename(tmp_entry, entry)
+        except OSError as e:
+            log.warning("Could not store tedana outputs in the cache: %s", e)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        log.info("Stored tedana outputs for %s in the cache (%s)", prefix, key)
+        self.evict()
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache fits its size limit."""
+        with self._lock(exclusive=True):
+            entries = []
+            for name in os.listdir(self.root):
+                if name.startswith("."):  # lock file and entries being stored
+                    continue
+                info = os.path.join(self.root, name, ENTRY_INFO)
+                if not os.path.exists(info):
+                    continue
+                with open(info) as f:
+                    size = json.load(f)["bytes"]
+                try:
+                    last_used = os.path.getmtime(os.path.join(self.root, name, LAST_USED))
+                except OSError:
+                    last_used = 0
+                entries.append((last_used, size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                log.info("Evicting cached tedana outputs %s (%.1f MB)", name, size / 1e6)
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                total -= size
@@ -0,0 +1,78 @@
+"""Durable progress record of a gear run, used to resume after an interruption.
+
+Every task moves through the stages in STAGES. The record is rewritten atomically
+after each change, so a job that is preempted or killed can be restarted and skip
+every stage that had already finished.
+"""
+
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+STAGES = ["extracted", "running", "completed", "reported", "archived"]
+
+STATE_FILENAME = ".tedana-state.json"
+
+# key of the session-level record (archive extraction and the session zip)
+SESSION = "session"
+
+
+class Checkpoint:
+    """Per-task stage record, persisted to a JSON file when a path is given.
+
+    Args:
+        path (str, optional): state file. Without it the record is kept in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = {}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+            log.info("Resuming from %s", path)
+            for name, record in sorted(self._state.items()):
+                log.info("  %s: %s", name, record.get("stage"))
+
+    def stage(self, name):
+        """Return the last stage reached by a task, or None."""
+        with self._lock:
+            return self._state.get(name, {}).get("stage")
+
+    def reached(self, name, stage) -> bool:
+        """Return True if a task has reached (or passed) a stage."""
+        current = self.stage(name)
+        return current is not None and STAGES.index(current) >= STAGES.index(stage)
+
+    def names(self):
+        """Return the names of the recorded tasks (and of the session record)."""
+        with self._lock:
+            return list(self._state)
+
+    def get(self, name, key, default=None):
+        """Return a value recorded for a task."""
+        with self._lock:
+            return self._state.get(name, {}).get(key, default)
+
+    def set(self, name, stage, **values):
+        """Record that a task has reached a stage, with optional values, and persist."""
+        with self._lock:
+            record = self._state.setdefault(name, {})
+            record["stage"] = stage
+            record.update(values)
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
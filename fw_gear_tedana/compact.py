@@ -0,0 +1,185 @@
+"""Compaction of the tedana outputs before they are archived.
+
+tedana writes its maps as float64 ``.nii.gz`` at the default gzip level. With
+"gear-compact-outputs", the NIfTI outputs of each task are rewritten once it is done:
+
+- float64 maps are stored as float32 when every value survives the conversion within
+  DOWNCAST_RTOL (relative to the value, or to the largest value of the map for
+  values near zero);
+- "gzip" recompresses them at "gear-compact-gzip-level", in parallel blocks;
+- "uncompressed" stores them as plain ``.nii``, leaving compression to the final zip
+  archive instead of compressing twice.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+from typing import Tuple
+
+from fw_gear_tedana.bids_index import has_prefix
+from utils.archive import gzip_stream
+from utils.resources import allocated_cpus
+
+log = logging.getLogger(__name__)
+
+COMPACT_MODES = ("off", "gzip", "uncompressed")
+
+DEFAULT_GZIP_LEVEL = 6
+
+# largest relative error accepted when storing a float64 map as float32
+DOWNCAST_RTOL = 1e-6
+
+# values compared at once, to bound the memory of the comparison
+CHUNK_VALUES = 8 * 1024 * 1024
+
+
+def nifti_base(path) -> str:
+    """Return the path of a NIfTI image without its .nii or .nii.gz extension."""
+    return path[: -len(".nii.gz")] if path.endswith(".nii.gz") else path[: -len(".nii")]
+
+
+def _slabs(shape):
+    """Yield indices of slabs along the last axis, of at most CHUNK_VALUES values each.
+
+    In the Fortran order of NIfTI data, each slab is one contiguous range of the file.
+    """
+    plane = 1
+    for dim in shape[:-1]:
+        plane *= dim
+    step = max(1, CHUNK_VALUES // max(1, plane))
+    for start in range(0, shape[-1], step):
+        yield (Ellipsis, slice(start, start + step))
+
+
+def fits_float32(chunk, atol) -> bool:
+    """Return True if float64 values can be stored as float32 within DOWNCAST_RTOL (or atol)."""
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    # values beyond the float32 range become inf, and fail the comparison
+    with np.errstate(over="ignore"):
+        narrow = chunk.astype(np.float32)
+    return bool(np.allclose(narrow, chunk, rtol=DOWNCAST_RTOL, atol=atol, equal_nan=True))
+
+
+def downcast(path, dest_path) -> bool:
+    """Write a float64 image as float32 to dest_path (.nii), if it fits.
+
+    The image is read twice, one slab at a time (see CHUNK_VALUES): once for its
+    largest value, then to check and write each slab, so memory stays bounded for
+    4D series too. Compaction runs outside the memory budget of the tedana runs.
+
+    Returns:
+        bool: whether dest_path was written
+    """
+    import nibabel as nib  # pylint: disable=import-outside-toplevel
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    img = nib.load(path, keep_file_open=True)
+    if img.header.get_data_dtype() != np.float64 or not img.shape:
+        return False
+    slabs = list(_slabs(img.shape))
+
+    largest = 0.0
+    for index in slabs:
+        chunk = np.asarray(img.dataobj[index])
+        largest = max(largest, float(np.max(np.abs(chunk[np.isfinite(chunk)]), initial=0.0)))
+    atol = DOWNCAST_RTOL * largest
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(None, None)  # the slabs are written with any scaling applied
+    header.set_data_offset(header.single_vox_offset + header.extensions.get_sizeondisk())
+    dtype = header.get_data_dtype()
+
+    with open(dest_path, "wb") as f:
+        header.write_to(f)
+        f.write(b"\0" * (header.get_data_offset() - f.tell()))
+        for index in slabs:
+            chunk = np.asarray(img.dataobj[index])
+            if not fits_float32(chunk, atol):
+                break
+            f.write(chunk.astype(dtype).tobytes(order="F"))
+        else:
+            return True
+
+    log.debug("%s does not fit in float32, kept as float64", os.path.basename(path))
+    os.remove(dest_path)
+    return False
+
+
+def compact_image(path, mode, level=DEFAULT_GZIP_LEVEL, n_threads=None) -> Tuple[str, bool]:
+    """Rewrite one NIfTI image: downcast it if possible, then (re)compress it.
+
+    Args:
+        path (str): .nii or .nii.gz image, replaced by the compacted one
+        mode (str): "gzip" or "uncompressed", see COMPACT_MODES
+        level (int): gzip level, for "gzip"
+        n_threads (int): compression threads
+
+    Returns:
+        dest (str): the compacted image (.nii.gz for "gzip", .nii for "uncompressed")
+        downcast (bool): whether it was converted to float32
+    """
+    base = nifti_base(path)
+    dest = base + (".nii.gz" if mode == "gzip" else ".nii")
+    float32 = base + ".float32.nii"
+    tmp = dest + ".tmp"
+
+    is_float32 = downcast(path, float32)
+    src = float32 if is_float32 else path
+    try:
+        if mode == "gzip":
+            with (gzip.open(src, "rb") if src.endswith(".gz") else open(src, "rb")) as f:
+                gzip_stream(f, tmp, level=level, n_threads=n_threads)
+        elif src.endswith(".gz"):
+            with gzip.open(src, "rb") as fin, open(tmp, "wb") as fout:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+        elif src == float32:
+            os.replace(src, tmp)
+        else:
+            # already an uncompressed float32 (or integer) image
+            return path, False
+        os.replace(tmp, dest)
+    finally:
+        for leftover in (tmp, float32):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    if dest != path:
+        os.remove(path)
+    return dest, is_float32
+
+
+def compact_outputs(gear_options: dict, spec: dict) -> dict:
+    """Compact the NIfTI outputs of one task, as set by "gear-compact-outputs".
+
+    Args:
+        gear_options (dict): gear options, with "compact-outputs" and "compact-gzip-level"
+        spec (dict): tedana run whose outputs were moved to its output folder
+
+    Returns:
+        stats (dict): number of files, of files downcast to float32, and bytes
+        before and after
+    """
+    mode = gear_options.get("compact-outputs") or "off"
+    level = gear_options.get("compact-gzip-level") or DEFAULT_GZIP_LEVEL
+    n_threads = allocated_cpus()
+    func_dir = spec["output_analysis_id_dir"]
+    images = [
+        os.path.join(func_dir, name) for name in sorted(os.listdir(func_dir))
+        if has_prefix(name, spec["prefix"]) and name.endswith((".nii", ".nii.gz"))
+    ]
+
+    stats = {"files": len(images), "downcast": 0, "bytes_in": 0, "bytes_out": 0}
+    for path in images:
+        stats["bytes_in"] += os.path.getsize(path)
+        dest, is_float32 = compact_image(path, mode, level, n_threads)
+        stats["bytes_out"] += os.path.getsize(dest)
+        stats["downcast"] += is_float32
+
+    log.info(
+        "Compacted %d outputs of %s (%d downcast to float32, %s): %.1f MB -> %.1f MB",
+        stats["files"], spec["prefix"], stats["downcast"], "gzip level %d" % level if mode == "gzip" else mode,
+        stats["bytes_in"] / 1e6, stats["bytes_out"] / 1e6,
+    )
+    return stats
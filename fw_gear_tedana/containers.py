@@ -0,0 +1,69 @@
+"""Cached lookups of Flywheel containers.
+
+Every client.get is a round trip to the platform. A ContainerResolver is created
+once per gear run and shared through gear_options["containers"], so each container
+is fetched at most once, and independent containers are fetched concurrently.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+
+log = logging.getLogger(__name__)
+
+# concurrent requests to the platform
+MAX_REQUESTS = 8
+
+
+class ContainerResolver:
+    """Flywheel container lookups, cached for the duration of a gear run.
+
+    Args:
+        client: Flywheel client (or a stand-in with the same get method)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, id_):
+        """Return a container, fetching it only the first time."""
+        with self._lock:
+            if id_ in self._cache:
+                return self._cache[id_]
+        container = self.client.get(id_)
+        with self._lock:
+            self.requests += 1
+            return self._cache.setdefault(id_, container)
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, object]:
+        """Return {id: container} for several containers, fetching the missing ones concurrently."""
+        ids = list(dict.fromkeys(i for i in ids if i))
+        with self._lock:
+            missing = [i for i in ids if i not in self._cache]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(MAX_REQUESTS, len(missing))) as pool:
+                list(pool.map(self.get, missing))
+        return {i: self.get(i) for i in ids}
+
+    def destination(self, destination_id) -> dict:
+        """Fetch the destination of the run together with its subject and session.
+
+        Returns:
+            dict: "destination" container, and the "subject" and "session"
+            containers (None when the destination is above them)
+        """
+        destination = self.get(destination_id)
+        parents = self.get_many([destination.parents.subject, destination.parents.session])
+        return {
+            "destination": destination,
+            "subject": parents.get(destination.parents.subject),
+            "session": parents.get(destination.parents.session),
+        }
+
+    def label(self, id_) -> str:
+        """Return the label of a container."""
+        return self.get(id_).label
@@ -0,0 +1,483 @@
+"""Execution backends for tedana runs.
+
+"command-line" launches the tedana executable for every run. "in-process" calls
+``tedana.workflows.tedana_workflow`` in long-lived worker processes, so numpy, scipy,
+sklearn, nilearn and nibabel are imported once per gear run instead of once per task.
+"slurm-array" submits the runs as the elements of a SLURM job array, so they can
+spread over several nodes.
+"""
+
+import importlib.util
+import inspect
+import logging
+import multiprocessing as mp
+import os
+import shlex
+import shutil
+import subprocess as sp
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.command_line import exec_command
+
+log = logging.getLogger(__name__)
+
+ENGINES = ["in-process", "command-line", "slurm-array"]
+
+# limit the threads of each concurrent tedana run to its share of the cpus
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+def tedana_argv(command):
+    """Split a command from generate_command into the arguments of the tedana cli.
+
+    Args:
+        command (list): command list starting with the tedana executable
+
+    Returns:
+        argv (list of str): arguments as they would be passed on the command line
+    """
+    return shlex.split(" ".join(command[1:]))
+
+
+def _init_worker():
+    """Import tedana once per worker process."""
+    import tedana.workflows  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+
+
+class _TaskStream:
+    """Stand-in for a worker's stdout or stderr while it runs one task.
+
+    Like stream_output does for the command-line engine, every complete line is
+    written to the original stream tagged with the task prefix, and untagged to the
+    task's log file.
+    """
+
+    def __init__(self, stream, tag, log_file=None, lock=None):
+        self.stream = stream
+        self.tag = tag
+        self.log_file = log_file
+        self.lock = lock or threading.Lock()
+        self._partial = ""
+
+    def write(self, text):
+        with self.lock:
+            *lines, self._partial = (self._partial + text).split("\n")
+            for line in lines:
+                self._write_line(line)
+        return len(text)
+
+    def _write_line(self, line):
+        # one write per line, so the lines of concurrent workers do not interleave
+        self.stream.write("[%s] %s\n" % (self.tag, line) if self.tag else line + "\n")
+        if self.log_file:
+            self.log_file.write(line + "\n")
+
+    def flush(self):
+        with self.lock:
+            if self._partial:
+                self._write_line(self._partial)
+                self._partial = ""
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+
+def _run_tedana_workflow(argv, n_threads, tag=None, log_path=None):
+    """Run one task in a worker process, with its output tagged and logged.
+
+    While the task runs, the worker's stdout and stderr (which tedana's console
+    handler is created on) are replaced by _TaskStream, and its complete output is
+    saved to log_path. A traceback of a failed run is added to the log file.
+
+    Args:
+        argv (list of str): tedana command line arguments
+        n_threads (int): number of BLAS/OpenMP threads for this run
+        tag (str, optional): task prefix, prepended to every output line
+        log_path (str, optional): file receiving the complete output of the run
+
+    Returns:
+        returncode (int): 0 on success
+        message (str): traceback if the run failed
+    """
+    streams = sys.stdout, sys.stderr
+    log_file = open(log_path, "w", buffering=1) if log_path else None
+    lock = threading.Lock()
+    sys.stdout = _TaskStream(streams[0], tag, log_file, lock)
+    sys.stderr = _TaskStream(streams[1], tag, log_file, lock)
+    try:
+        run_error, message = _tedana_workflow(argv, n_threads)
+        if run_error and log_file:
+            log_file.write(message + "\n")
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = streams
+        if log_file:
+            log_file.close()
+    return run_error, message
+
+
+def _tedana_workflow(argv, n_threads):
+    """Run tedana_workflow in a worker process.
+
+    The arguments are mapped onto keyword arguments by tedana's own parser, so the
+    in-process run accepts exactly what the command line accepts.
+
+    Args:
+        argv (list of str): tedana command line arguments
+        n_threads (int): number of BLAS/OpenMP threads for this run
+
+    Returns:
+        returncode (int): 0 on success
+        message (str): traceback if the run failed
+    """
+    try:
+        # pylint: disable=import-outside-toplevel
+        from threadpoolctl import threadpool_limits
+        from tedana.utils import teardown_loggers
+        from tedana.workflows.tedana import _get_parser, tedana_workflow
+
+        kwargs = vars(_get_parser().parse_args(argv))
+        kwargs.pop("n_threads", None)
+        if "tedana_command" in inspect.signature(tedana_workflow).parameters:
+            kwargs["tedana_command"] = "tedana " + " ".join(argv)
+        with threadpool_limits(limits=n_threads, user_api=None):
+            try:
+                tedana_workflow(**kwargs)
+            finally:
+                # tedana only removes its log and report handlers when it returns normally;
+                # the worker runs other tasks after this one
+                teardown_loggers()
+    except SystemExit as exc:  # argparse errors
+        return exc.code or 2, "tedana rejected the arguments: %s" % " ".join(argv)
+    except Exception:  # pylint: disable=broad-except
+        return 1, traceback.format_exc()
+
+    return 0, ""
+
+
+class CommandLineEngine:
+    """Run each task by launching the tedana executable.
+
+    The output of each run is logged line by line, tagged with its task prefix, and
+    saved to "logs/<prefix>.log" in the work directory. The log of a failed run is
+    copied to the output directory.
+    """
+
+    name = "command-line"
+    # runs use the resources of the gear's own allocation
+    remote = False
+
+    def __init__(self, gear_options: dict, n_workers: int):
+        self.gear_options = gear_options
+        self.n_workers = n_workers
+
+    def run(self, spec: dict, n_threads: int) -> int:
+        """Run tedana for one task.
+
+        Args:
+            spec (dict): tedana run, see fmriprep_task_spec
+            n_threads (int): number of BLAS/OpenMP threads for this run
+
+        Returns:
+            run_error (int): 0 on success
+
+        Raises:
+            RuntimeError: if tedana exits with a non-zero return code
+        """
+        environ = dict(self.gear_options["environ"])
+        for var in THREAD_ENV_VARS:
+            environ[var] = str(n_threads)
+
+        log_path = self.log_path(spec)
+        try:
+            _, _, run_error = exec_command(
+                spec["command"],
+                dry_run=self.gear_options["dry-run"],
+                environ=environ,
+                shell=True,
+                cont_output=True,
+                cwd=self.gear_options["work-dir"],
+                tag=spec["prefix"],
+                log_path=log_path,
+            )
+        except RuntimeError:
+            self.save_log(spec, log_path)
+            raise
+        return run_error
+
+    def log_path(self, spec: dict) -> str:
+        """Return the log file of a task, "logs/<prefix>.log" in the work directory."""
+        log_dir = os.path.join(self.gear_options["work-dir"], "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        return os.path.join(log_dir, spec["prefix"] + ".log")
+
+    def save_log(self, spec: dict, log_path):
+        """Copy the log of a failed task to the output directory."""
+        if os.path.exists(log_path):
+            shutil.copyfile(log_path, os.path.join(self.gear_options["output-dir"], "tedana_%s.log" % spec["prefix"]))
+
+    def close(self):
+        """Release the resources of the engine."""
+
+
+class InProcessEngine(CommandLineEngine):
+    """Run each task with tedana_workflow in a pool of long-lived worker processes.
+
+    Workers are forked from a server process that has already imported tedana. The
+    output of each run is tagged and logged as for the command-line engine (see
+    _run_tedana_workflow). When a worker dies (killed for memory, crashed), the pool is broken: the runs it
+    held fail, and the pool is replaced so the following runs still get workers.
+    """
+
+    name = "in-process"
+
+    def __init__(self, gear_options: dict, n_workers: int):
+        super().__init__(gear_options, n_workers)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                ctx = mp.get_context("forkserver")
+                ctx.set_forkserver_preload(["tedana.workflows"])
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.n_workers, mp_context=ctx, initializer=_init_worker
+                )
+            return self._pool
+
+    def _discard_pool(self, pool):
+        """Shut down a broken pool, unless another run already replaced it."""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def run(self, spec: dict, n_threads: int) -> int:
+        argv = tedana_argv(spec["command"])
+        log.info("Running tedana_workflow: \n %s \n\n", " ".join(argv))
+        if self.gear_options["dry-run"]:
+            log.info("Dry run mode set.")
+            return 0
+
+        pool = self._get_pool()
+        log_path = self.log_path(spec)
+        try:
+            run_error, message = pool.submit(_run_tedana_workflow, argv, n_threads, spec["prefix"], log_path).result()
+        except BrokenProcessPool as exc:
+            self._discard_pool(pool)
+            log.error("The tedana worker process of %s died: %s", spec["prefix"], exc)
+            self.save_log(spec, log_path)
+            raise RuntimeError("tedana_workflow has failed for {}".format(spec["prefix"])) from exc
+        log.info("tedana_workflow return code: %s", run_error)
+        if run_error != 0:
+            log.error(message)
+            self.save_log(spec, log_path)
+            raise RuntimeError("tedana_workflow has failed for {}".format(spec["prefix"]))
+
+        return run_error
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+class _ArrayBatch:
+    """Runs collected into one job array."""
+
+    def __init__(self):
+        self.specs = []
+        self.last = time.monotonic()
+        self.closed = False
+        self.results = {}
+        self.done = threading.Event()
+
+
+class SlurmArrayEngine(CommandLineEngine):
+    """Run each task as one element of a SLURM job array.
+
+    Runs requested within batch_seconds of each other (all of them, when no task is
+    restored from the cache or skipped on resume) are submitted as one
+    ``sbatch --array`` job. Each element gets the resources of the slurm-* config.
+    The job is polled with squeue until it leaves the queue, and the state of each
+    element is read with sacct. The work directory must be on a filesystem shared
+    with the compute nodes.
+    """
+
+    name = "slurm-array"
+    remote = True
+    # seconds between two squeue polls
+    poll_seconds = 30
+    # seconds without a new run after which the collected runs are submitted
+    batch_seconds = 5
+    # sacct may lag behind squeue: attempts to read the final element states
+    sacct_attempts = 5
+
+    # sbatch option for each slurm-* config
+    SBATCH_OPTIONS = {
+        "slurm-cpu": "cpus-per-task",
+        "slurm-ram": "mem-per-cpu",
+        "slurm-ntasks": "ntasks",
+        "slurm-nodes": "nodes",
+        "slurm-partition": "partition",
+        "slurm-qos": "qos",
+        "slurm-account": "account",
+        "slurm-time": "time",
+    }
+
+    def __init__(self, gear_options: dict, n_workers: int):
+        super().__init__(gear_options, n_workers)
+        self._cond = threading.Condition()
+        self._batch = None
+        self._n_arrays = 0
+
+    def run(self, spec: dict, n_threads: int) -> int:
+        if self.gear_options["dry-run"]:
+            log.info("Dry run mode set, not submitting: \n %s \n\n", " ".join(spec["command"]))
+            return 0
+
+        with self._cond:
+            leader = self._batch is None or self._batch.closed
+            if leader:
+                self._batch = _ArrayBatch()
+            batch = self._batch
+            index = len(batch.specs)
+            batch.specs.append(spec)
+            batch.last = time.monotonic()
+            self._cond.notify_all()
+
+        if leader:
+            self._run_batch(batch)
+        batch.done.wait()
+
+        state, log_path = batch.results[index]
+        if state != "COMPLETED":
+            if log_path:
+                self.save_log(spec, log_path)
+            raise RuntimeError("SLURM array element for {} ended with {}".format(spec["prefix"], state))
+        return 0
+
+    def _run_batch(self, batch):
+        """Wait for the runs of a batch, submit them and wait for the job to finish."""
+        with self._cond:
+            while len(batch.specs) < self.n_workers:
+                remaining = batch.last + self.batch_seconds - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch.closed = True
+
+        try:
+            job_dir, job_id = self._submit(batch.specs)
+            states = self._wait(job_id, len(batch.specs))
+            for i, spec in enumerate(batch.specs):
+                log_path = os.path.join(job_dir, "%d.log" % i)
+                if os.path.exists(log_path):
+                    shutil.copyfile(log_path, os.path.join(self.gear_options["work-dir"], "logs", spec["prefix"] + ".log"))
+                batch.results[i] = (states.get(i, "UNKNOWN"), log_path)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error("SLURM job array failed: %s", exc)
+            for i in range(len(batch.specs)):
+                batch.results.setdefault(i, ("SUBMIT FAILED", None))
+        finally:
+            batch.done.set()
+
+    def _submit(self, specs):
+        """Write the job script of an array and submit it with sbatch."""
+        self._n_arrays += 1
+        job_dir = os.path.join(self.gear_options["work-dir"], "slurm", "array-%d" % self._n_arrays)
+        os.makedirs(job_dir, exist_ok=True)
+        os.makedirs(os.path.join(self.gear_options["work-dir"], "logs"), exist_ok=True)
+
+        commands = os.path.join(job_dir, "commands.txt")
+        with open(commands, "w") as f:
+            for spec in specs:
+                f.write(" ".join(spec["command"]) + "\n")
+
+        lines = ["#!/bin/bash", "#SBATCH --job-name=tedana-%s" % self.gear_options["destination-id"]]
+        lines.append("#SBATCH --array=0-%d" % (len(specs) - 1))
+        for key, option in self.SBATCH_OPTIONS.items():
+            if self.gear_options.get(key):
+                lines.append("#SBATCH --%s=%s" % (option, self.gear_options[key]))
+        lines.append("#SBATCH --output=%s" % os.path.join(job_dir, "%a.log"))
+        for var in THREAD_ENV_VARS:
+            lines.append("export %s=${SLURM_CPUS_PER_TASK:-1}" % var)
+        lines.append('command=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" %s)' % shlex.quote(commands))
+        container = self.gear_options["environ"].get("SINGULARITY_CONTAINER")
+        if container:
+            # run the element in the same image as the gear
+            lines.append("exec singularity exec --bind %s %s bash -c \"$command\"" % (
+                shlex.quote(str(self.gear_options["work-dir"])), shlex.quote(container)))
+        else:
+            lines.append('eval "$command"')
+        script = os.path.join(job_dir, "job.sh")
+        with open(script, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        result = sp.run(["sbatch", "--parsable", script], stdout=sp.PIPE, stderr=sp.PIPE,
+                        universal_newlines=True, cwd=job_dir, check=False)
+        if result.returncode != 0:
+            raise RuntimeError("sbatch failed: %s" % result.stderr.strip())
+        job_id = result.stdout.strip().split(";")[0]
+        log.info("Submitted %d tedana runs as SLURM job array %s", len(specs), job_id)
+        return job_dir, job_id
+
+    def _wait(self, job_id, n_elements):
+        """Poll a job array until it leaves the queue, and return the state of each element."""
+        while True:
+            result = sp.run(["squeue", "-h", "-j", job_id, "-o", "%i %T"], stdout=sp.PIPE, stderr=sp.PIPE,
+                            universal_newlines=True, check=False)
+            queued = [line for line in result.stdout.splitlines() if line.strip()]
+            # squeue fails once the job is no longer known to the controller
+            if result.returncode != 0 or not queued:
+                break
+            log.debug("SLURM job %s: %d elements queued or running", job_id, len(queued))
+            time.sleep(self.poll_seconds)
+
+        states = {}
+        for attempt in range(self.sacct_attempts):
+            result = sp.run(["sacct", "-n", "-P", "-X", "-j", job_id, "-o", "JobID,State,ExitCode"],
+                            stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, check=False)
+            for line in result.stdout.splitlines():
+                element, _, rest = line.partition("|")
+                array_id, _, index = element.partition("_")
+                if array_id == job_id and index.isdigit():
+                    state, _, exit_code = rest.partition("|")
+                    states[int(index)] = "COMPLETED" if state == "COMPLETED" and exit_code == "0:0" else state
+            if len(states) == n_elements and all(s not in ("PENDING", "RUNNING") for s in states.values()):
+                break
+            time.sleep(min(self.poll_seconds, 2 ** attempt))
+
+        log.info("SLURM job %s finished: %s", job_id, ", ".join("%d=%s" % i for i in sorted(states.items())))
+        return states
+
+
+def get_engine(gear_options: dict, n_workers: int):
+    """Create the execution backend selected by "gear-tedana-engine".
+
+    Falls back to the command line when tedana cannot be imported by the gear.
+
+    Args:
+        gear_options (dict): gear-specific options
+        n_workers (int): number of tasks that may run at the same time
+
+    Returns:
+        engine: CommandLineEngine, InProcessEngine or SlurmArrayEngine
+    """
+    name = gear_options.get("tedana-engine") or ENGINES[0]
+    if name == InProcessEngine.name and importlib.util.find_spec("tedana") is None:
+        log.warning("tedana cannot be imported, falling back to the command line engine")
+        name = CommandLineEngine.name
+
+    engine = {e.name: e for e in (InProcessEngine, CommandLineEngine, SlurmArrayEngine)}.get(name, CommandLineEngine)
+    log.info("Using %s tedana engine", engine.name)
+    return engine(gear_options, n_workers)
@@ -0,0 +1,99 @@
+"""Selective extraction of the fmriprep session archive.
+
+Only the members a tedana run needs are extracted: the multi-echo
+``desc-preproc_bold`` images, their JSON sidecars and (optionally) the brain masks.
+"""
+
+import fnmatch
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from zipfile import ZipFile, ZipInfo
+
+from utils.resources import allocated_cpus
+
+log = logging.getLogger(__name__)
+
+ECHO_PATTERNS = ["*echo*desc-preproc_bold.nii.gz", "*echo*desc-preproc_bold.json"]
+MASK_PATTERNS = ["*desc-brain_mask.nii.gz"]
+
+COPY_BUFSIZE = 1024 * 1024
+# default number of extraction threads at most: every member is read through the one
+# shared archive file and written to the same disk, so more threads mostly add contention
+MAX_THREADS = 8
+
+
+def fmriprep_members(infolist: List[ZipInfo], explicit_mask=False) -> List[ZipInfo]:
+    """Select the archive members needed to run tedana.
+
+    Args:
+        infolist (list of ZipInfo): central directory of the fmriprep archive
+        explicit_mask (bool): also select the fmriprep brain masks
+
+    Returns:
+        members (list of ZipInfo): members in the "func" folders matching the patterns
+    """
+    patterns = ECHO_PATTERNS + (MASK_PATTERNS if explicit_mask else [])
+
+    members = []
+    for info in infolist:
+        if info.is_dir():
+            continue
+        parts = info.filename.split("/")
+        if len(parts) < 2 or parts[-2] != "func":
+            continue
+        if any(fnmatch.fnmatch(parts[-1], p) for p in patterns):
+            members.append(info)
+
+    return members
+
+
+def extract_members(zf: ZipFile, members: List[ZipInfo], dest, n_threads=None) -> List[str]:
+    """Extract the selected members of an open archive using several threads.
+
+    zlib releases the GIL while inflating, so members are decompressed in parallel.
+    Only opening and closing member streams is serialized on the shared archive.
+
+    Args:
+        zf (ZipFile): archive opened for reading
+        members (list of ZipInfo): members to extract
+        dest (str): directory to extract to
+        n_threads (int, optional): number of threads. Defaults to the allocated cpus,
+            at most MAX_THREADS.
+
+    Returns:
+        files (list of str): paths of the extracted files
+    """
+    n_threads = n_threads or min(MAX_THREADS, allocated_cpus())
+    lock = threading.Lock()
+
+    targets = []
+    for info in members:
+        parts = info.filename.split("/")
+        if info.filename.startswith("/") or ".." in parts:
+            log.warning("Skipping unsafe archive member %s", info.filename)
+            continue
+        target = os.path.join(dest, *parts)
+        # create folders up front so the workers never race on makedirs
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        targets.append((info, target))
+
+    def _extract(item):
+        info, target = item
+        with lock:
+            src = zf.open(info)
+        try:
+            with open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+        finally:
+            with lock:
+                src.close()
+        return target
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        files = list(pool.map(_extract, targets))
+
+    return files
@@ -0,0 +1,144 @@
+"""Eager removal of scratch files that no pending task needs any more.
+
+Without it, the work directory holds the whole extracted fmriprep tree and the
+outputs of every task until the gear exits. With "gear-eager-cleanup", the pool
+keeps a reference count of the extracted inputs (echoes, sidecars, masks) of the
+tasks it has not finished yet:
+
+- when a task finishes, the inputs that no other pending task uses are deleted;
+- when the last task of a session finishes, its extracted fmriprep tree is deleted;
+- with per-task archives, the outputs of a task are deleted once they are archived.
+
+Only files below the work directory are removed, never the gear inputs. It is
+disabled with gear-resume, which keeps intermediate files on purpose, and for dry runs.
+"""
+
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from fw_gear_tedana.compact import nifti_base
+from utils.resources import format_size
+
+log = logging.getLogger(__name__)
+
+
+def enabled(gear_options: dict) -> bool:
+    """Return whether scratch files are removed as soon as they are no longer needed."""
+    return bool(gear_options.get("eager-cleanup")) and not gear_options.get("resume") and not gear_options["dry-run"]
+
+
+def task_inputs(spec: dict) -> List[str]:
+    """Return the files a tedana run reads: echoes, their JSON sidecars and the mask."""
+    files = list(spec["echo_files"])
+    files += [nifti_base(f) + ".json" for f in spec["echo_files"] if os.path.exists(nifti_base(f) + ".json")]
+    if spec["arg_options"].get("mask"):
+        files.append(spec["arg_options"]["mask"])
+    return files
+
+
+def _below(path, folder) -> bool:
+    """Return whether path is folder or below it."""
+    path, folder = os.path.realpath(str(path)), os.path.realpath(str(folder))
+    return path == folder or path.startswith(folder + os.sep)
+
+
+def _remove(path) -> int:
+    """Remove a file or a folder, and return the bytes it held on disk."""
+    size = 0
+    if os.path.isdir(path):
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+                except OSError:
+                    pass
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        size = os.lstat(path).st_blocks * 512
+        os.remove(path)
+    return size
+
+
+class InputTracker:
+    """Reference counts of the scratch inputs of the pending tasks.
+
+    Args:
+        root (str): work directory; only files below it are ever removed
+    """
+
+    def __init__(self, root):
+        self.root = os.path.realpath(str(root))
+        self.freed_bytes = 0
+        self._refs: Dict[str, int] = {}
+        self._tasks: Dict[str, Tuple[List[str], Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_jobs(cls, gear_options: dict, jobs: List[Tuple[dict, dict]]) -> Optional["InputTracker"]:
+        """Track the inputs of the given tasks, if "gear-eager-cleanup" applies to them."""
+        if not enabled(gear_options):
+            return None
+        tracker = cls(gear_options["work-dir"])
+        for options, spec in jobs:
+            tree = os.path.dirname(options["fmriprep-dir"]) if options.get("fmriprep-dir") else None
+            if tree and _below(spec["output_analysis_id_dir"], tree):
+                tree = None  # the outputs are written inside it
+            tracker.add(spec["prefix"], task_inputs(spec), tree)
+        return tracker
+
+    def _owned(self, path) -> bool:
+        return _below(path, self.root) and os.path.realpath(path) != self.root
+
+    def add(self, task, files: List[str], tree=None):
+        """Register the input files of a pending task, and the extracted tree they come from."""
+        files = [f for f in files if self._owned(f)]
+        tree = tree if tree and self._owned(tree) else None
+        with self._lock:
+            self._tasks[task] = (files, tree)
+            for path in files + ([tree] if tree else []):
+                self._refs[path] = self._refs.get(path, 0) + 1
+
+    def release(self, task):
+        """Remove the inputs of a finished task that no pending task needs any more."""
+        with self._lock:
+            files, tree = self._tasks.pop(task, ([], None))
+            unused = []
+            for path in files + ([tree] if tree else []):
+                self._refs[path] -= 1
+                if self._refs[path] == 0:
+                    del self._refs[path]
+                    unused.append(path)
+
+        freed = sum(_remove(path) for path in unused)
+        with self._lock:
+            self.freed_bytes += freed
+        if unused:
+            log.debug("Removed %d inputs of %s (%s)", len(unused), task, format_size(freed))
+        if tree in unused:
+            log.info("Removed the extracted fmriprep tree %s, no pending task needs it", tree)
+
+
+def remove_outputs(files: List[Tuple[str, str]]) -> int:
+    """Remove archived task outputs, and the folders they leave empty.
+
+    Args:
+        files (list): (path, arcname) tuples, see main.task_output_files
+
+    Returns:
+        freed (int): bytes removed
+    """
+    freed = 0
+    folders = set()
+    for path, _ in files:
+        freed += _remove(path)
+        folders.add(os.path.dirname(path))
+    # deepest first, so a report's figures folder goes before the report folder
+    for folder in sorted(folders, key=len, reverse=True):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass  # still holds other outputs
+    return freed
@@ -5,26 +5,26 @@ import os
 import os.path as op
 import glob
 from pathlib import Path
-from typing import List, Tuple
 import subprocess as sp
-import numpy as np
-import pandas as pd
-import sys
 import re
 import shutil
-import tempfile
-from collections import OrderedDict
-from zipfile import ZIP_DEFLATED, ZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import errorhandler
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple
 import json
-from flywheel_gear_toolkit.utils.zip_tools import zip_output
-from flywheel_gear_toolkit.interfaces.command_line import (
-    build_command_list
-)
 
-from utils.command_line import exec_command
-from utils.zip_htmls import zip_htmls
+from fw_gear_tedana.bids_index import FuncIndex, has_prefix, parse_bids_name
+from fw_gear_tedana.cache import ResultCache
+from fw_gear_tedana.checkpoint import SESSION
+from fw_gear_tedana.compact import compact_outputs
+from fw_gear_tedana.engine import get_engine
+from fw_gear_tedana.lifecycle import InputTracker, enabled as eager_cleanup, remove_outputs
+from fw_gear_tedana.planner import MemoryBudget, estimate_memory, execution_plan, plan_memory
+from fw_gear_tedana.preflight import check_echoes, check_fmriprep_tasks
+from fw_gear_tedana.staging import StagingArea, task_size
+from utils.archive import BackgroundArchiver, tree_files, zip_files, zip_tree
+from utils.resources import allocated_cpus, available_memory, format_size, parse_size
+from utils.zip_htmls import flatten_htmls, zip_htmls
 
 log = logging.getLogger(__name__)
 
@@ -44,10 +44,15 @@ def prepare(
 
     It should:
      - Install FreeSurfer license (if needed)
+     - Check the inputs of every task before the first tedana run (pre-flight)
 
     Same for FW and RL instances.
     Potentially, this could be BIDS-App independent?
 
+    The pre-flight reads only NIfTI headers and JSON sidecars. The geometry of each
+    task's echoes is kept in gear_options["headers"] for the later stages, and is used
+    to check that the memory available is enough for the largest task.
+
     Args:
         gear_options (Dict): gear options
         app_options (Dict): options for the app
@@ -56,14 +61,55 @@ def prepare(
         errors (list[str]): list of generated errors
         warnings (list[str]): list of generated warnings
     """
-    # pylint: disable=unused-argument
-    # for now, no errors or warnings, but leave this in place to allow future methods
-    # to return an error
     errors: List[str] = []
     warnings: List[str] = []
 
+    if not app_options.get("inputtype"):
+        errors.append("No usable inputs, see the errors above")
+
+    elif app_options.get("inputtype") == "fmriprep":
+        with gear_options["metrics"].phase("preflight"):
+            index = FuncIndex(op.join(fmriprep_session_dir(gear_options, app_options), "func"))
+            errors, warnings, gear_options["headers"] = check_fmriprep_tasks(
+                index, fmriprep_get_tasks(index), explicit_mask=app_options["explicit-mask"]
+            )
+    elif app_options.get("inputtype") == "manual":
+        with gear_options["metrics"].phase("preflight"):
+            prefix, echo_files, echo_times = manual_echoes(gear_options, app_options)
+            errors, warnings, header = check_echoes(prefix, echo_files, echo_times=echo_times)
+            gear_options["headers"] = {prefix: header}
+
+    if app_options.get("inputtype") in ("fmriprep", "manual"):
+        # make sure the largest task fits in memory, and suggest a memory request
+        estimates = {task: estimate_memory(header) for task, header in gear_options["headers"].items()}
+        if gear_options.get("tedana-engine") == "slurm-array":
+            # every run gets its own allocation of slurm-ram per cpu
+            n_cpus = int(gear_options.get("slurm-cpu") or 1)
+            available = parse_size(gear_options.get("slurm-ram") or "0") * n_cpus
+            log.info("Memory of each SLURM array element: %s", format_size(available))
+            memory_errors, memory_warnings = plan_memory(estimates, available, 1, n_cpus)
+        else:
+            gear_options["available-memory"], source = available_memory(
+                gear_options.get("slurm-ram"), gear_options.get("slurm-cpu")
+            )
+            log.info("Memory limit: %s (%s)", format_size(gear_options["available-memory"]), source)
+            memory_errors, memory_warnings = plan_memory(
+                estimates, gear_options["available-memory"], task_workers(gear_options, len(estimates)),
+                allocated_cpus(),
+            )
+        if gear_options["dry-run"]:
+            # a dry run still writes its plan, which shows the memory to request
+            memory_warnings += memory_errors
+            memory_errors = []
+        errors += memory_errors
+        warnings += memory_warnings
+
+    for warning in warnings:
+        log.warning(warning)
+    for error in errors:
+        log.error(error)
+
     return errors, warnings
-    # pylint: enable=unused-argument
 
 
 def run(gear_options: dict, app_options: dict) -> int:
@@ -86,6 +132,10 @@ def run(gear_options: dict, app_options: dict) -> int:
     else:
         run_error = run_manual_pipe(gear_options, app_options)
 
+    if run_error == 0 and gear_options.get("resume") and not gear_options["dry-run"]:
+        log.info("Run complete, removing resume folder %s", gear_options["work-dir"])
+        shutil.rmtree(gear_options["work-dir"], ignore_errors=True)
+
     return run_error
 
 
@@ -100,104 +150,551 @@ def run_fmriprep_pipe(gear_options: dict, app_options: dict) -> int:
         run_error: any error encountered running the app. (0: no error)
     """
 
-    path = op.join(gear_options["fmriprep-dir"], "sub-" + app_options["sid"], "ses-" + app_options["sesid"])
-    tasks = fmriprep_get_tasks(path)
+    with gear_options["metrics"].phase("discover"):
+        task_specs = fmriprep_task_specs(gear_options, app_options)
 
-    # run tedana workflow for each task
-    for task in tasks:
-        echo_files = fmriprep_get_echos(path, task)
+    if error_handler.fired:
+        log.critical('Failure: exiting with code 1 due to logged errors')
+        run_error = 1
+        return run_error
 
-        if '' in echo_files:
-            continue
+    checkpoint = gear_options["checkpoint"]
+    for spec in task_specs:
+        if checkpoint.stage(spec["prefix"]) is None:
+            checkpoint.set(spec["prefix"], "extracted")
 
-        # pull echo time from .json
-        echo_times = [];
-        arg_options = dict()
-        for e in echo_files:
-            with open(e.replace("nii.gz", "json")) as f:
-                dat = json.load(f)
-                echo_times.append(dat["EchoTime"] * 1000)
+    run_error = run_tasks(gear_options, task_specs)
 
-        log.info("Using multiecho files: %s", "\n".join(echo_files))
-        log.info("Using echo times (ms): %s", str(echo_times))
+    if not gear_options["dry-run"]:
+        archive_outputs(gear_options, app_options)
+
+    return run_error
 
-        arg_options["d"] = " ".join(echo_files)
-        arg_options["e"] = " ".join([str(i) for i in echo_times])
 
-        index = [idx for idx, s in enumerate(echo_files[0].split("/")[-1].split("_")) if 'echo' in s][0]
-        arg_options["prefix"] = "_".join(echo_files[0].split("/")[-1].split("_")[0:index])
+def archive_outputs(gear_options: dict, app_options: dict):
+    """Zip the outputs of all tasks into the session archive.
 
-        if app_options["explicit-mask"]:
-            f = searchfiles(app_options["prefix"] + "_desc-brain_mask.nii.gz")
-            arg_options["mask"] = f[0]
-            log.info("Explicit mask requested using file: %s", f[0])
-
-        if app_options["output-layout"] == "bids":
-            output_analysis_id_dir = op.join(gear_options["work-dir"], gear_options["destination-id"], "fmriprep",
-                                             "derivatives", "tedana", "sub-" + app_options["sid"],
-                                             "ses-" + app_options["sesid"], "func")
-            os.makedirs(output_analysis_id_dir, exist_ok=True)
-            arg_options["out-dir"] = output_analysis_id_dir
+    In the "per-task" archive mode, the tasks were already archived one by one, so
+    only a manifest of their archives is written, and an archive of any remaining
+    session-level files.
+    """
+    zipname = "tedana_" + app_options.get("archive-label", app_options["sesid"]) + "_" + gear_options["destination-id"]
+    if gear_options.get("archive-mode") == "per-task":
+        write_session_manifest(gear_options, app_options, zipname)
+        gear_options["checkpoint"].set(SESSION, "archived")
+        return
+
+    with gear_options["metrics"].phase("archive") as record:
+        record.update(zip_tree(
+            op.join(gear_options["work-dir"], gear_options["destination-id"]),
+            op.join(gear_options["output-dir"], zipname + ".zip"),
+            arcroot=gear_options["destination-id"],
+        ))
+    gear_options["checkpoint"].set(SESSION, "archived")
+
+
+def write_session_manifest(gear_options: dict, app_options: dict, zipname):
+    """Write the manifest of the per-task archives of a session.
+
+    Files of the session that belong to no task are archived in <zipname>.zip.
+    """
+    checkpoint = gear_options["checkpoint"]
+    root = op.join(gear_options["work-dir"], gear_options["destination-id"])
+    prefixes = [name for name in checkpoint.names() if name != SESSION]
+
+    archives = []
+    for prefix in sorted(prefixes):
+        path = checkpoint.get(prefix, "task_archive")
+        if path and op.exists(path):
+            archives.append({
+                "task": prefix,
+                "file": op.basename(path),
+                "bytes": op.getsize(path),
+                "members": checkpoint.get(prefix, "task_archive_files"),
+            })
+
+    manifest = {
+        "destination": gear_options["destination-id"],
+        "subject": app_options["sid"],
+        "session": app_options["sesid"],
+        "archives": archives,
+    }
+
+    leftovers = [
+        (path, arcname) for path, arcname in tree_files(root, arcroot=gear_options["destination-id"])
+        if not any(has_prefix(part, prefix) for prefix in prefixes for part in arcname.split("/"))
+    ]
+    if leftovers:
+        with gear_options["metrics"].phase("archive") as record:
+            record.update(zip_files(leftovers, op.join(gear_options["output-dir"], zipname + ".zip")))
+        manifest["session_archive"] = zipname + ".zip"
+
+    with open(op.join(gear_options["output-dir"], zipname + "_manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    log.info("Wrote the manifest of %d task archives to %s", len(archives), zipname + "_manifest.json")
+
+
+def task_output_files(gear_options: dict, spec: dict) -> List[Tuple[str, str]]:
+    """List the outputs of one task (files and report folder named after its prefix).
+
+    Returns:
+        list of (path, arcname) tuples, named as in the session archive
+    """
+    root = op.join(gear_options["work-dir"], gear_options["destination-id"])
+    func_dir = spec["output_analysis_id_dir"]
+    files = []
+    for name in sorted(os.listdir(func_dir)):
+        if not has_prefix(name, spec["prefix"]):
+            continue
+        path = op.join(func_dir, name)
+        arcname = gear_options["destination-id"] + "/" + op.relpath(path, root).replace(os.sep, "/")
+        if op.isdir(path):
+            files += tree_files(path, arcroot=arcname)
         else:
-            output_analysis_id_dir = op.join(gear_options["work-dir"], gear_options["destination-id"], "fmriprep",
-                                             "sub-" + app_options["sid"], "ses-" + app_options["sesid"], "func")
-            os.makedirs(output_analysis_id_dir, exist_ok=True)
-            arg_options["out-dir"] = output_analysis_id_dir
+            files.append((path, arcname))
+    return files
 
-        arg_options["command-line-args"] = app_options["command-line-args"]
 
-        # generate command
-        command = generate_command(gear_options, arg_options)
+def archive_task(gear_options: dict, spec: dict, archiver: BackgroundArchiver):
+    """Queue the archive of one task's outputs in the background ("per-task" archive mode)."""
+    prefix = spec["prefix"]
+    checkpoint = gear_options["checkpoint"]
+    dest_zip = op.join(gear_options["output-dir"], "tedana_%s_%s.zip" % (prefix, gear_options["destination-id"]))
+    if checkpoint.get(prefix, "task_archive") == dest_zip and op.exists(dest_zip):
+        return
 
-        if error_handler.fired:
-            log.critical('Failure: exiting with code 1 due to logged errors')
-            run_error = 1
-            return run_error
+    files = task_output_files(gear_options, spec)
 
-        # This is what it is all about
-        stdout, stderr, run_error = exec_command(
-            command,
-            dry_run=gear_options["dry-run"],
-            shell=True,
-            cont_output=True,
-            cwd=gear_options["work-dir"]
+    def _done(stats):
+        checkpoint.set(prefix, "archived", task_archive=dest_zip, task_archive_files=stats["files"])
+        if eager_cleanup(gear_options):
+            # the archive is all that is uploaded, the outputs are not needed any more
+            remove_outputs(files)
+
+    archiver.submit(
+        prefix, files, dest_zip,
+        phase=lambda: gear_options["metrics"].phase("archive", task=prefix), callback=_done,
+    )
+
+
+def fmriprep_session_dir(gear_options: dict, app_options: dict) -> str:
+    """Return the fmriprep folder of the session being processed."""
+    return op.join(gear_options["fmriprep-dir"], "sub-" + app_options["sid"], "ses-" + app_options["sesid"])
+
+
+def fmriprep_task_specs(gear_options: dict, app_options: dict) -> List[dict]:
+    """Collect everything needed to run tedana for each task of the fmriprep session."""
+    index = FuncIndex(op.join(fmriprep_session_dir(gear_options, app_options), "func"))
+    task_specs = []
+    for task in fmriprep_get_tasks(index):
+        spec = fmriprep_task_spec(gear_options, app_options, index, task)
+        if spec:
+            task_specs.append(spec)
+    return task_specs
+
+
+def fmriprep_task_spec(gear_options: dict, app_options: dict, index: FuncIndex, task) -> dict:
+    """Collect the inputs, arguments and output locations for one tedana run.
+
+    Arguments:
+        gear_options: dict with gear-specific options
+        app_options: dict with options for the BIDS-App
+        index: index of the fmriprep func folder
+        task: task label returned by fmriprep_get_tasks
+
+    Returns:
+        spec: dict describing the tedana run, or None if it cannot be run
+    """
+    echo_files = fmriprep_get_echos(index, task)
+
+    if not echo_files:
+        return None
+
+    # pull echo time from .json
+    echo_times = [];
+    for e in echo_files:
+        sidecar = index.sidecar(e)
+        if not sidecar:
+            log.error("No JSON sidecar found for %s", e)
+            return None
+        with open(sidecar) as f:
+            dat = json.load(f)
+            echo_times.append(dat["EchoTime"] * 1000)
+
+    prefix = parse_bids_name(echo_files[0]).prefix
+
+    mask = None
+    if app_options["explicit-mask"]:
+        mask = index.mask(prefix)
+        if not mask:
+            log.error("Explicit mask requested but no brain mask found for %s", prefix)
+            return None
+        log.info("Explicit mask requested using file: %s", mask)
+
+    return task_spec(gear_options, app_options, task, prefix, echo_files, echo_times, mask)
+
+
+def task_spec(gear_options: dict, app_options: dict, task, prefix, echo_files, echo_times, mask=None) -> dict:
+    """Build the description of one tedana run.
+
+    Arguments:
+        gear_options: dict with gear-specific options
+        app_options: dict with options for the BIDS-App
+        task: key of the task in gear_options["headers"]
+        prefix: prefix of the tedana outputs
+        echo_files: echo images, ordered by echo number
+        echo_times: echo times (ms)
+        mask: explicit brain mask, or None
+
+    Returns:
+        spec: dict describing the tedana run
+    """
+    log.info("Using multiecho files: %s", "\n".join(echo_files))
+    log.info("Using echo times (ms): %s", str(echo_times))
+
+    arg_options = dict()
+    arg_options["d"] = " ".join(echo_files)
+    arg_options["e"] = " ".join([str(i) for i in echo_times])
+
+    arg_options["prefix"] = prefix
+
+    if mask:
+        arg_options["mask"] = mask
+
+    if app_options["output-layout"] == "bids":
+        output_analysis_id_dir = op.join(gear_options["work-dir"], gear_options["destination-id"], "fmriprep",
+                                         "derivatives", "tedana", "sub-" + app_options["sid"],
+                                         "ses-" + app_options["sesid"], "func")
+    else:
+        output_analysis_id_dir = op.join(gear_options["work-dir"], gear_options["destination-id"], "fmriprep",
+                                         "sub-" + app_options["sid"], "ses-" + app_options["sesid"], "func")
+    os.makedirs(output_analysis_id_dir, exist_ok=True)
+
+    # each run writes to its own folder, so concurrent runs never collide on the
+    # un-prefixed report files; results are moved to the output folder afterwards
+    arg_options["out-dir"] = op.join(gear_options["work-dir"], "tedana-" + arg_options["prefix"])
+
+    arg_options["command-line-args"] = app_options["command-line-args"]
+
+    return {
+        "task": task,
+        "header": gear_options.get("headers", {}).get(task),
+        "prefix": arg_options["prefix"],
+        "echo_files": echo_files,
+        "echo_times": echo_times,
+        "arg_options": arg_options,
+        "output_analysis_id_dir": output_analysis_id_dir,
+        "command": generate_command(gear_options, arg_options),
+    }
+
+
+def run_tasks(gear_options: dict, task_specs: List[dict]) -> int:
+    """Run tedana for all tasks on a bounded pool of workers.
+
+    Arguments:
+        gear_options: dict with gear-specific options
+        task_specs: tedana runs, see fmriprep_task_spec
+
+    Returns:
+        run_error: any error encountered running the app. (0: no error)
+
+    Raises:
+        RuntimeError: if any of the tedana runs failed, after all runs have finished.
+    """
+    if not task_specs:
+        log.warning("No multi-echo tasks found.")
+        return 0
+
+    if gear_options["dry-run"]:
+        plan_tasks(gear_options, [(gear_options, spec) for spec in task_specs])
+        return 0
+
+    failures = run_task_pool(gear_options, [(gear_options, spec) for spec in task_specs])
+
+    if failures:
+        raise RuntimeError(
+            "%d of %d tedana tasks failed: %s" % (len(failures), len(task_specs), next(iter(failures.values())))
         )
 
-        # if gear completed without error, move report to also contain acq prefix
-        # run_error = 0
-        if run_error == 0:
+    return 0
 
-            report_path = op.join(output_analysis_id_dir, arg_options["prefix"]+"_report")
-            os.makedirs(report_path, exist_ok=True)
 
-            files = searchfiles(os.path.join(arg_options["out-dir"], "report*"), dryrun=False)
-            files.extend(searchfiles(os.path.join(arg_options["out-dir"], "tedana*"), dryrun=False))
-            files.extend(searchfiles(os.path.join(arg_options["out-dir"], "figures"), dryrun=False))
-            files = [i for i in files if i]  #remove empty elements
-            for f in files:
-                f = Path(f)
-                if arg_options["prefix"] in f.name:
-                    continue
+def run_task_pool(gear_options: dict, jobs: List[Tuple[dict, dict]]) -> Dict[str, Exception]:
+    """Run tedana tasks, possibly of several sessions, on one bounded pool of workers.
 
-                shutil.move(str(f), op.join(f.parent, arg_options["prefix"]+"_report"))
+    Concurrency is set by "gear-n-workers", defaulting to the allocated cpus. The
+    cpus are shared evenly between the concurrent tedana runs. The runs are executed
+    by the backend selected with "gear-tedana-engine". A run only starts when its
+    estimated peak memory fits next to the runs already in progress. With
+    "gear-stage-uncompressed", the echoes are decompressed to scratch before each run.
 
-            os.rename(op.join(report_path,"tedana_report.html"), op.join(report_path,"tedana_report.html").replace("tedana", arg_options["prefix"]))
+    Arguments:
+        gear_options: dict with the gear options shared by the pool
+        jobs: (gear options of the task's session, tedana run) pairs
 
-            # Make archives for result *.html files for easy display on platform
-            zip_htmls(gear_options["output-dir"], gear_options["destination-id"], report_path)
+    Returns:
+        failures: exception of each failed task, by prefix
+    """
+    task_specs = [spec for _, spec in jobs]
+    n_cpus = allocated_cpus()
+    n_workers = task_workers(gear_options, len(task_specs))
+    n_threads = max(1, n_cpus // n_workers)
+    log.info("Running %d tedana tasks on %d workers (%d threads each)",
+             len(task_specs), n_workers, n_threads)
+
+    engine = get_engine(gear_options, n_workers)
+    cache = ResultCache.from_options(gear_options)
+    if engine.remote:
+        # runs are submitted to other nodes: wait for all of them at once, without
+        # local memory limits or staging in local memory
+        n_workers = engine.n_workers = len(task_specs)
+        budget = staging = None
+    else:
+        if "available-memory" not in gear_options:
+            gear_options["available-memory"], _ = available_memory(
+                gear_options.get("slurm-ram"), gear_options.get("slurm-cpu")
+            )
+        budget = MemoryBudget(gear_options["available-memory"])
+        staging = StagingArea.from_options(gear_options, task_specs)
+    archiver = None
+    if gear_options.get("archive-mode") == "per-task" and not gear_options["dry-run"]:
+        archiver = BackgroundArchiver(n_threads=max(1, min(n_threads, n_cpus // 2)))
+    tracker = InputTracker.from_jobs(gear_options, jobs)
+    failures = {}
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = {
+                pool.submit(run_task, options, spec, engine, n_threads, cache, staging, budget, archiver): spec
+                for options, spec in jobs
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:  # pylint: disable=broad-except
+                    log.error("tedana failed for %s: %s", futures[future]["prefix"], exc)
+                    failures[futures[future]["prefix"]] = exc
+                if tracker:
+                    # the task is done, successful or not: its inputs can go
+                    tracker.release(futures[future]["prefix"])
+    finally:
+        engine.close()
+        if staging:
+            staging.close()
+        if archiver:
+            for prefix, exc in archiver.wait().items():
+                log.error("Could not archive the outputs of %s: %s", prefix, exc)
+                failures.setdefault(prefix, exc)
+        if tracker:
+            log.info("Removed %s of extracted inputs while the tasks ran", format_size(tracker.freed_bytes))
+
+    return failures
+
+
+def plan_tasks(gear_options: dict, jobs: List[Tuple[dict, dict]]) -> dict:
+    """Write the execution plan of tedana tasks instead of running them (dry run).
+
+    For each task, the plan lists the echoes and echo times, the tedana command, the
+    voxel and volume counts from the headers, and the estimated peak memory, runtime
+    and output size (see planner.execution_plan), along with the scratch space and a
+    SLURM request for the whole job. It is written to tedana_plan_<analysis id>.json
+    in the output folder.
 
-    if not gear_options["dry-run"]:
-        # zip outputs
-        zipname = "tedana_" + app_options["sesid"] + "_" + gear_options["destination-id"]
-        cmd = "zip -r " + os.path.join(gear_options["output-dir"], zipname) + ".zip " + gear_options["destination-id"]
-        execute_shell(cmd, dryrun=gear_options["dry-run"], cwd=gear_options["work-dir"])
+    Arguments:
+        gear_options: dict with the gear options shared by the pool
+        jobs: (gear options of the task's session, tedana run) pairs
+
+    Returns:
+        plan: the plan that was written
+    """
+    staged = bool(gear_options.get("stage-uncompressed"))
+    remote = gear_options.get("tedana-engine") == "slurm-array"
+    if remote:
+        # every run is an array element with its own slurm-cpu cpus
+        n_workers = len(jobs)
+        n_cpus = n_threads = int(gear_options.get("slurm-cpu") or 1)
+    else:
+        n_cpus = allocated_cpus()
+        n_workers = task_workers(gear_options, len(jobs))
+        n_threads = max(1, n_cpus // n_workers)
+
+    tasks = []
+    for _, spec in jobs:
+        tasks.append({
+            "task": spec["prefix"],
+            "echo_files": spec["echo_files"],
+            "echo_times": spec["echo_times"],
+            "mask": spec["arg_options"].get("mask"),
+            "command": " ".join(spec["command"]),
+            "header": spec["header"],
+            "input_bytes": sum(op.getsize(f) for f in spec["echo_files"]),
+            "staged_bytes": task_size(spec) if staged else 0,
+        })
+
+    plan = execution_plan(tasks, n_workers, n_threads, n_cpus, remote=remote, staged=staged)
+    plan = dict(destination=gear_options["destination-id"], engine=gear_options.get("tedana-engine"), **plan)
+
+    path = op.join(gear_options["output-dir"], "tedana_plan_" + gear_options["destination-id"] + ".json")
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2)
+
+    for task in plan["tasks"]:
+        log.info("Plan for %s: %s voxels x %s volumes x %d echoes, ~%s memory, ~%d s, ~%s of outputs",
+                 task["task"], task["voxels"], task["volumes"], len(task["echo_files"]),
+                 format_size(task["estimated_memory_bytes"]), task["estimated_runtime_seconds"],
+                 format_size(task["estimated_output_bytes"]))
+    log.info("Dry run: %d tasks on %d workers would take ~%d s, ~%s peak memory and ~%s of scratch; "
+             "suggested %s. Plan written to %s",
+             len(tasks), n_workers, plan["runtime_seconds"], format_size(plan["peak_memory_bytes"]),
+             format_size(plan["scratch_bytes"]),
+             ", ".join("%s=%s" % item for item in plan["suggested_slurm"].items()), path)
+    return plan
+
+
+def task_workers(gear_options: dict, n_tasks: int) -> int:
+    """Return the number of tasks to run at once ("gear-n-workers" or the allocated cpus)."""
+    return max(1, min(gear_options.get("n-workers") or allocated_cpus(), n_tasks))
+
+
+def run_task(
+    gear_options: dict, spec: dict, engine, n_threads=1, cache=None, staging=None, budget=None, archiver=None
+) -> int:
+    """Run tedana for one task, then move and archive its report.
 
-        # Make archives for result *.html files for easy display on platform
-        # zip_htmls(gear_options["output-dir"], gear_options["destination-id"], output_analysis_id_dir)
+    Arguments:
+        gear_options: dict with gear-specific options
+        spec: tedana run, see fmriprep_task_spec
+        engine: execution backend, see fw_gear_tedana.engine
+        n_threads: number of BLAS/OpenMP threads for this run
+        cache: ResultCache to restore outputs from instead of running tedana
+        staging: StagingArea to decompress the echoes to before running tedana
+        budget: MemoryBudget the run reserves its estimated peak memory from
+        archiver: BackgroundArchiver to archive the task's outputs as soon as it is done
+
+    Returns:
+        run_error: any error encountered running the app. (0: no error)
+    """
+    out_dir = spec["arg_options"]["out-dir"]
+    prefix = spec["prefix"]
+    checkpoint = gear_options["checkpoint"]
+    metrics = gear_options["metrics"]
+    dry_run = gear_options["dry-run"]
+
+    if checkpoint.reached(prefix, "completed"):
+        log.info("tedana already completed for %s, skipping", prefix)
+        run_error = 0
+    else:
+        if checkpoint.stage(prefix) == "running":
+            log.info("Discarding partial outputs of interrupted run for %s", prefix)
+            shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir, exist_ok=True)
+        if not dry_run:
+            checkpoint.set(prefix, "running")
+
+        key = cache.key(spec) if cache else None
+        if key and cache.restore(key, out_dir):
+            run_error = 0
+        else:
+            run_spec = spec
+            if staging:
+                with metrics.phase("stage", task=prefix):
+                    echo_files = staging.stage(prefix, spec["echo_files"], task_size(spec))
+                run_spec = with_echo_files(gear_options, spec, echo_files)
+
+            # This is what it is all about
+            memory = estimate_memory(spec["header"])
+            try:
+                if budget:
+                    budget.acquire(memory)
+                try:
+                    with metrics.phase("tedana", task=prefix) as record:
+                        record["estimated_memory"] = memory
+                        run_error = engine.run(run_spec, n_threads)
+                finally:
+                    if budget:
+                        budget.release(memory)
+            finally:
+                if staging:
+                    staging.release(prefix)
+
+            if key and run_error == 0:
+                cache.store(key, out_dir, prefix=prefix)
+
+        if run_error == 0 and not dry_run:
+            checkpoint.set(prefix, "completed")
+
+    # if gear completed without error, move report to also contain acq prefix
+    if run_error == 0 and not dry_run:
+        if not checkpoint.reached(prefix, "reported"):
+            with metrics.phase("report-move", task=prefix):
+                checkpoint.set(prefix, "reported", report_path=move_task_outputs(spec))
+        report_path = checkpoint.get(prefix, "report_path")
+
+        # shrink the NIfTI outputs before they are archived
+        if gear_options.get("compact-outputs") not in (None, "off") and not checkpoint.get(prefix, "compacted"):
+            with metrics.phase("compact", task=prefix) as record:
+                record.update(compact_outputs(gear_options, spec))
+            checkpoint.set(prefix, checkpoint.stage(prefix), compacted=True)
+
+        # Make archives (or self-contained copies) of result *.html files for easy display on platform
+        archives = checkpoint.get(prefix, "archives", [])
+        if not (checkpoint.reached(prefix, "archived") and all(op.exists(a) for a in archives)):
+            if gear_options.get("report-format") == "standalone":
+                with metrics.phase("flatten-htmls", task=prefix):
+                    archives = flatten_htmls(gear_options["output-dir"], gear_options["destination-id"], report_path)
+            else:
+                with metrics.phase("zip-htmls", task=prefix):
+                    archives = zip_htmls(gear_options["output-dir"], gear_options["destination-id"], report_path)
+            checkpoint.set(prefix, "archived", archives=archives)
+
+        if archiver:
+            archive_task(gear_options, spec, archiver)
 
     return run_error
 
 
+def with_echo_files(gear_options: dict, spec: dict, echo_files: List[str]) -> dict:
+    """Return a copy of a tedana run reading its echoes from other files."""
+    if echo_files == spec["echo_files"]:
+        return spec
+    arg_options = dict(spec["arg_options"], d=" ".join(echo_files))
+    return dict(spec, echo_files=echo_files, arg_options=arg_options,
+                command=generate_command(gear_options, arg_options))
+
+
+def move_task_outputs(spec: dict) -> str:
+    """Move the outputs of one tedana run into the output folder.
+
+    The report files are collected in "<prefix>_report", everything else is moved
+    next to the outputs of the other tasks.
+
+    Arguments:
+        spec: tedana run, see fmriprep_task_spec
+
+    Returns:
+        report_path: folder containing the report for this task
+    """
+    out_dir = spec["arg_options"]["out-dir"]
+    prefix = spec["prefix"]
+    output_analysis_id_dir = spec["output_analysis_id_dir"]
+
+    report_path = op.join(output_analysis_id_dir, prefix + "_report")
+    os.makedirs(report_path, exist_ok=True)
+
+    for f in sorted(Path(out_dir).iterdir()):
+        if prefix not in f.name and (f.name.startswith(("report", "tedana")) or f.name == "figures"):
+            dest = op.join(report_path, f.name)
+        else:
+            dest = op.join(output_analysis_id_dir, f.name)
+        if op.isdir(dest):
+            shutil.rmtree(dest)
+        shutil.move(str(f), dest)
+    os.rmdir(out_dir)
+
+    os.rename(op.join(report_path, "tedana_report.html"), op.join(report_path, prefix + "_report.html"))
+
+    return report_path
+
+
 def run_manual_pipe(gear_options: dict, app_options: dict) -> int:
     """Run tedana using manual inputs.
 
@@ -209,31 +706,80 @@ def run_manual_pipe(gear_options: dict, app_options: dict) -> int:
         run_error: any error encountered running the app. (0: no error)
     """
 
-    # TODO write this method!
+    metrics = gear_options["metrics"]
 
-    log.info("manual input run not currently supported")
-    pass
+    with metrics.phase("discover"):
+        prefix, echo_files, echo_times = manual_echoes(gear_options, app_options)
+        if app_options["explicit-mask"]:
+            log.warning("explicit-mask needs the fmriprep_zip input, tedana will compute its own mask")
 
+    if error_handler.fired or None in echo_times or len(echo_times) != len(echo_files):
+        log.critical('Failure: exiting with code 1 due to logged errors')
+        run_error = 1
+        return run_error
 
-def fmriprep_get_tasks(path):
+    spec = task_spec(gear_options, app_options, prefix, prefix, echo_files, echo_times)
 
-    # search for all func "bold.nii.gz" func files to choose from..
-    results = []
-    files = searchfiles(os.path.join(path,"func","*echo*bold.nii.gz"))
-    for f in files:
-        index1 = [idx for idx, s in enumerate(f.split("/")[-1].split("_")) if 'task' in s][0]
-        index2 = [idx for idx, s in enumerate(f.split("/")[-1].split("_")) if 'echo' in s][0]
-        res = "_".join(f.split("/")[-1].split("_")[index1:index2])
+    checkpoint = gear_options["checkpoint"]
+    if checkpoint.stage(prefix) is None:
+        checkpoint.set(prefix, "extracted")
 
-        results.append(res)
+    run_error = run_tasks(gear_options, [spec])
 
-    return list(set(results))
+    if not gear_options["dry-run"]:
+        archive_outputs(gear_options, app_options)
+
+    return run_error
 
 
-def fmriprep_get_echos(path, task):
+def manual_echoes(gear_options: dict, app_options: dict) -> Tuple[str, List[str], List[float]]:
+    """Collect the echoes passed as fmri_echo_N inputs and their echo times.
 
-    files = searchfiles(os.path.join(path, "func", "*" + task + "*echo*desc-preproc_bold.nii.gz"))
-    return files
+    The echo times come from the "echo-times" config (ms). Otherwise each echo's time
+    is read from a JSON sidecar next to it, or from the EchoTime (s) of its Flywheel
+    file info.
+
+    Arguments:
+        gear_options: dict with gear-specific options
+        app_options: dict with options for the BIDS-App
+
+    Returns:
+        prefix: prefix of the tedana outputs, from the name of the first echo
+        echo_files: echo images, in input order
+        echo_times: echo times (ms), None where unknown
+    """
+    echo_files = gear_options["fmri_echo_files"]
+
+    if app_options.get("echo-times"):
+        try:
+            echo_times = [float(t) for t in app_options["echo-times"].replace(",", " ").split()]
+        except ValueError:
+            log.error("Cannot parse echo-times %s", app_options["echo-times"])
+            echo_times = [None] * len(echo_files)
+    else:
+        echo_times = []
+        for path, info in zip(echo_files, gear_options["fmri_echo_info"]):
+            sidecar = re.sub(r"\.nii(\.gz)?$", ".json", path)
+            if sidecar != path and op.exists(sidecar):
+                with open(sidecar) as f:
+                    info = json.load(f)
+            echo_time = info.get("EchoTime")
+            echo_times.append(echo_time * 1000 if echo_time is not None else None)
+
+    bids = parse_bids_name(echo_files[0])
+    prefix = bids.prefix if bids and bids.prefix else "sub-%s_ses-%s" % (app_options["sid"], app_options["sesid"])
+
+    return prefix, echo_files, echo_times
+
+
+def fmriprep_get_tasks(index: FuncIndex) -> List[str]:
+    """Return the tasks with multi-echo preprocessed bold images in the index."""
+    return index.tasks()
+
+
+def fmriprep_get_echos(index: FuncIndex, task) -> List[str]:
+    """Return the preprocessed echoes of a task, ordered by echo number."""
+    return index.echoes(task)
 
 
 def generate_command(
@@ -275,6 +821,10 @@ def generate_command(
     # code.  Add descriptions of problems to errors & warnings lists.
     # print("command_parameters:", json.dumps(command_parameters, indent=4))
 
+    # flywheel_gear_toolkit imports the Flywheel SDK, only needed once a command is built
+    # pylint: disable=import-outside-toplevel
+    from flywheel_gear_toolkit.interfaces.command_line import build_command_list
+
     cmd = build_command_list(cmd, command_parameters)
 
 
@@ -300,19 +850,7 @@ def execute_shell(cmd, dryrun=False, cwd=os.getcwd()):
 
 
 def searchfiles(path, dryrun=False) -> list[str]:
-    cmd = "ls -d " + path
-
-    log.debug("\n %s", cmd)
+    log.debug("\n searching %s", path)
 
     if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        files = stdout.strip("\n").split("\n")
-        return files
-
-
+        return sorted(glob.glob(path))
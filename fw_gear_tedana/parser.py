@@ -1,20 +1,23 @@
 """Parser module to parse gear config.json."""
-from typing import Tuple
+from typing import TYPE_CHECKING, Tuple
 from zipfile import ZipFile
-from flywheel_gear_toolkit import GearToolkitContext
 import os
 import logging
-import glob
-import subprocess as sp
 from pathlib import Path
-from fw_gear_tedana.main import searchfiles
+from fw_gear_tedana.checkpoint import SESSION, STATE_FILENAME, Checkpoint
+from fw_gear_tedana.containers import ContainerResolver
+from fw_gear_tedana.extract import extract_members, fmriprep_members
+from utils.metrics import Metrics
+
+if TYPE_CHECKING:
+    from flywheel_gear_toolkit import GearToolkitContext
 
 
 log = logging.getLogger(__name__)
 
 
 def parse_config(
-        gear_context: GearToolkitContext,
+        gear_context: "GearToolkitContext",
 ) -> Tuple[dict, dict]:
     """Parse the config and other options from the context, both gear and app options.
 
@@ -30,10 +33,46 @@ def parse_config(
         "destination-id": gear_context.destination["id"],
         "work-dir": gear_context.work_dir,
         "client": gear_context.client,
+        "containers": ContainerResolver(gear_context.client),
         "environ": os.environ,
+        "metrics": Metrics(),
         "debug": gear_context.config.get("debug"),
+        "n-workers": gear_context.config.get("gear-n-workers"),
+        "tedana-engine": gear_context.config.get("gear-tedana-engine"),
+        "writable-dir": gear_context.config.get("gear-writable-dir"),
+        "archive-mode": gear_context.config.get("gear-archive-mode"),
+        "compact-outputs": gear_context.config.get("gear-compact-outputs"),
+        "eager-cleanup": gear_context.config.get("gear-eager-cleanup"),
+        "compact-gzip-level": gear_context.config.get("gear-compact-gzip-level"),
+        "report-format": gear_context.config.get("gear-report-format"),
+        "cache-size": gear_context.config.get("gear-cache-size"),
+        "resume": gear_context.config.get("gear-resume"),
+        "stage-uncompressed": gear_context.config.get("gear-stage-uncompressed"),
+        "stage-budget": gear_context.config.get("gear-stage-budget"),
+        "slurm-cpu": gear_context.config.get("slurm-cpu"),
+        "slurm-ram": gear_context.config.get("slurm-ram"),
+        "slurm-ntasks": gear_context.config.get("slurm-ntasks"),
+        "slurm-nodes": gear_context.config.get("slurm-nodes"),
+        "slurm-partition": gear_context.config.get("slurm-partition"),
+        "slurm-qos": gear_context.config.get("slurm-qos"),
+        "slurm-account": gear_context.config.get("slurm-account"),
+        "slurm-time": gear_context.config.get("slurm-time"),
     }
 
+    if gear_options["resume"]:
+        # keep all intermediate files in a folder that outlives the job, so a
+        # restarted job can continue where this one stopped
+        gear_options["work-dir"] = (
+            Path(gear_options["writable-dir"]) / ("tedana-resume-" + gear_options["destination-id"])
+        )
+        gear_options["work-dir"].mkdir(parents=True, exist_ok=True)
+        gear_options["checkpoint"] = Checkpoint(str(gear_options["work-dir"] / STATE_FILENAME))
+    else:
+        gear_options["checkpoint"] = Checkpoint()
+
+    # the peak disk use of the run is recorded with the metrics
+    gear_options["metrics"].watch_disk(gear_options["work-dir"], gear_options["output-dir"])
+
     # set the output dir name for the BIDS app:
     gear_options["output_analysis_id_dir"] = (
             gear_options["output-dir"] / gear_options["destination-id"]
@@ -52,31 +91,59 @@ def parse_config(
     if work_dir:
         app_options["work-dir"] = work_dir
 
-    if gear_context.get_input_path("fmriprep_zip") and not gear_context.get_input_path("fmri_echo_1"):
+    # the destination, its subject and its session are fetched once, for the whole run
+    containers = gear_options["containers"].destination(gear_context.destination["id"])
+    destination = containers["destination"]
+
+    file_inputs = gear_context.get_input_path("fmriprep_zip") or gear_context.get_input_path("fmri_echo_1")
+
+    if destination.parent.type in ("project", "subject") and file_inputs:
+        log.error(
+            "Inputs were given to a run at the %s level. Run on a session to process the inputs, "
+            "or without inputs to process every session below the %s (batch mode).",
+            destination.parent.type, destination.parent.type,
+        )
+
+    elif destination.parent.type in ("project", "subject"):
+        # batch mode: every session below the destination, see fw_gear_tedana.batch
+        app_options["inputtype"] = "batch"
+        gear_options["batch-parent-id"] = destination.parent.id
+        gear_options["batch-parent-type"] = destination.parent.type
+        gear_options["batch-downloads"] = gear_context.config.get("gear-batch-downloads")
+        log.info("Running in batch mode for %s %s", destination.parent.type, destination.parent.id)
+
+    elif gear_context.get_input_path("fmriprep_zip") and not gear_context.get_input_path("fmri_echo_1"):
         app_options["inputtype"] = "fmriprep"
         gear_options["fmriprep_zipfile"] = gear_context.get_input_path("fmriprep_zip")
         log.info("Inputs file path, %s", gear_options["fmriprep_zipfile"])
 
-        with ZipFile(gear_options["fmriprep_zipfile"], "r") as f:
-            fmriprep_anlys_id = [item.split('/')[0] for item in f.namelist()][0]
-
         # unzip preproc folder and reorganize
-        unzip_file(gear_options, gear_options["fmriprep_zipfile"])
+        checkpoint = gear_options["checkpoint"]
+        if checkpoint.reached(SESSION, "extracted"):
+            fmriprep_anlys_id = checkpoint.get(SESSION, "analysis_id")
+            log.info("fmriprep archive was already extracted, skipping")
+        else:
+            with gear_options["metrics"].phase("extract"):
+                fmriprep_anlys_id = unzip_file(gear_options, gear_options["fmriprep_zipfile"],
+                                               explicit_mask=app_options["explicit-mask"])
+            checkpoint.set(SESSION, "extracted", analysis_id=fmriprep_anlys_id)
 
         gear_options["fmriprep-dir"] = os.path.join(gear_options["work-dir"], fmriprep_anlys_id, "fmriprep")
 
     elif gear_context.get_input_path("fmri_echo_1") and not gear_context.get_input_path("fmriprep_zip"):
         app_options["inputtype"] = "manual"
-        gear_options["fmri_echo_1_file"] = gear_context.get_input_path("fmri_echo_1")
-        log.info("Inputs file path, %s", gear_options["fmri_echo_1_file"])
 
-        if gear_context.get_input_path("fmri_echo_2"):
-            gear_options["fmri_echo_2_file"] = gear_context.get_input_path("fmri_echo_2")
-            log.info("Inputs file path, %s", gear_options["fmri_echo_2_file"])
-
-        if gear_context.get_input_path("fmri_echo_3"):
-            gear_options["fmri_echo_3_file"] = gear_context.get_input_path("fmri_echo_3")
-            log.info("Inputs file path, %s", gear_options["fmri_echo_3_file"])
+        # echoes are passed to tedana where Flywheel put them, nothing is copied
+        gear_options["fmri_echo_files"] = []
+        gear_options["fmri_echo_info"] = []
+        n = 1
+        while gear_context.get_input_path("fmri_echo_%d" % n):
+            name = "fmri_echo_%d" % n
+            gear_options["fmri_echo_files"].append(gear_context.get_input_path(name))
+            file_object = gear_context.get_input_file_object(name) or {}
+            gear_options["fmri_echo_info"].append(file_object.get("info") or {})
+            log.info("Inputs file path, %s", gear_options["fmri_echo_files"][-1])
+            n += 1
 
     else:
         log.error("No inputs or inputs mismatch passed. Cannot proceed. Exiting.")
@@ -87,28 +154,41 @@ def parse_config(
         "params": ""
     }
 
-    destination = gear_context.client.get(gear_context.destination["id"])
-    sid = gear_context.client.get(destination.parents.subject)
-    sesid = gear_context.client.get(destination.parents.session)
-
-    app_options["sid"] = sid.label
-    app_options["sesid"] = sesid.label
+    if app_options.get("inputtype") in ("fmriprep", "manual"):
+        app_options["sid"] = containers["subject"].label
+        app_options["sesid"] = containers["session"].label
 
     return gear_options, app_options
 
 
-def unzip_file(gear_options, zip_filename):
+def unzip_file(gear_options, zip_filename, explicit_mask=False):
     """
-    unzip_file unzips the contents of zipped gear output into the working
-    directory.
+    unzip_file extracts the members of zipped gear output needed by tedana into the
+    working directory.
     Args:
         gear_options: The gear context object
             containing the 'gear_dict' dictionary attribute with key/value,
             'gear-dry-run': boolean to enact a dry run for debugging
         zip_filename (string): The file to be unzipped
+        explicit_mask (bool): also extract the fmriprep brain masks
+
+    Returns:
+        analysis_id (string): top level folder of the archive
     """
-    z = ZipFile(zip_filename, "r")
     log.info("Unzipping zipped directory contents, %s", zip_filename)
 
-    z.extractall(gear_options["work-dir"])
+    with ZipFile(zip_filename, "r") as z:
+        infolist = z.infolist()
+        analysis_id = infolist[0].filename.split("/")[0]
+
+        members = fmriprep_members(infolist, explicit_mask=explicit_mask)
+        log.info("Extracting %d of %d archive members (%.1f of %.1f MB)",
+                 len(members), len(infolist),
+                 sum(m.file_size for m in members) / 1e6,
+                 sum(m.file_size for m in infolist) / 1e6)
+
+        extract_members(z, members, gear_options["work-dir"])
+
     log.info(f'Unzipped the file to {gear_options["work-dir"]}')
+
+    return analysis_id
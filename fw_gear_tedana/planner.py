@@ -0,0 +1,224 @@
+"""Resource planning for tedana runs, based on NIfTI header metadata.
+
+The peak memory of a tedana run is estimated as::
+
+    voxels x volumes x echoes x dtype width x MEMORY_MULTIPLIER + BASE_MEMORY
+
+tedana upcasts the data to float64 and keeps several working copies (optimal
+combination, PCA, ICA, component maps), which MEMORY_MULTIPLIER accounts for.
+
+For dry runs, the runtime and output size of each run are estimated the same way,
+from the number of samples (voxels x volumes x echoes), and combined into an
+execution plan (see execution_plan).
+"""
+
+import heapq
+import logging
+import math
+import threading
+from typing import Dict, List, Tuple
+
+from utils.resources import format_size
+
+log = logging.getLogger(__name__)
+
+# peak memory relative to the size of the raw echo data; a starting value, refit it to
+# the runs of a site with benchmarks/calibrate_planner.py
+MEMORY_MULTIPLIER = 10.0
+# interpreter plus the scientific python stack
+BASE_MEMORY = 1536 * 1024 ** 2
+# head room left for the gear itself when suggesting a memory request
+HEADROOM = 1.2
+
+# seconds per sample (voxel x volume x echo) on one thread, and the fraction of that
+# work that BLAS/OpenMP threads speed up; refit them to the runs of a site with
+# benchmarks/calibrate_planner.py
+RUNTIME_PER_SAMPLE = 1.0e-6
+PARALLEL_FRACTION = 0.5
+# imports, mask computation and report generation
+BASE_RUNTIME = 60.0
+# compressed outputs relative to one float32 copy of the optimally combined series
+# (denoised, accepted and rejected series, component maps and tables, report)
+OUTPUT_MULTIPLIER = 3.0
+
+
+def estimate_memory(header: dict) -> int:
+    """Estimate the peak memory (bytes) of a tedana run from the geometry of its echoes.
+
+    Args:
+        header (dict): geometry of the echoes, see preflight.check_echoes
+
+    Returns:
+        estimate (int): bytes
+    """
+    if not header:
+        return BASE_MEMORY
+    raw = n_voxels(header) * header["n_volumes"] * header["n_echoes"] * header["itemsize"]
+    return int(raw * MEMORY_MULTIPLIER + BASE_MEMORY)
+
+
+def n_voxels(header: dict) -> int:
+    """Return the number of voxels of one volume of the echoes."""
+    voxels = 1
+    for dim in header["shape"][:3]:
+        voxels *= dim
+    return voxels
+
+
+def estimate_runtime(header: dict, n_threads=1) -> float:
+    """Estimate the runtime (seconds) of a tedana run with n_threads threads."""
+    if not header:
+        return BASE_RUNTIME
+    samples = n_voxels(header) * header["n_volumes"] * header["n_echoes"]
+    speedup = (1 - PARALLEL_FRACTION) + PARALLEL_FRACTION / max(1, n_threads)
+    return BASE_RUNTIME + samples * RUNTIME_PER_SAMPLE * speedup
+
+
+def estimate_output_size(header: dict) -> int:
+    """Estimate the size (bytes) of the outputs of a tedana run."""
+    if not header:
+        return 0
+    return int(n_voxels(header) * header["n_volumes"] * 4 * OUTPUT_MULTIPLIER)
+
+
+def schedule(runtimes: List[float], n_workers: int) -> float:
+    """Return the wall time of running tasks on n_workers, longest first."""
+    workers = [0.0] * max(1, n_workers)
+    for runtime in sorted(runtimes, reverse=True):
+        heapq.heapreplace(workers, workers[0] + runtime)
+    return max(workers)
+
+
+def execution_plan(tasks: List[dict], n_workers: int, n_threads: int, n_cpus: int, remote=False,
+                   staged=False) -> dict:
+    """Combine the estimates of all tasks into an execution plan.
+
+    Args:
+        tasks (list of dict): one entry per task, with its "header" (replaced by its
+            shape and TR), "input_bytes" (echoes as stored) and "staged_bytes"
+            (echoes decompressed)
+        n_workers (int): number of tasks run at once
+        n_threads (int): threads of each run
+        n_cpus (int): cpus of the job (of each array element for remote runs)
+        remote (bool): whether every run gets its own allocation (slurm-array engine)
+        staged (bool): whether the echoes are decompressed to scratch before each run
+
+    Returns:
+        plan (dict): the tasks with their estimates added, and the totals: peak
+        memory, wall time, output size, scratch space, and a suggested SLURM request
+    """
+    for task in tasks:
+        header = task.pop("header") or {}
+        task.update({
+            "shape": header.get("shape"),
+            "tr": header.get("tr"),
+            "voxels": n_voxels(header) if header else None,
+            "volumes": header.get("n_volumes"),
+            "estimated_memory_bytes": estimate_memory(header),
+            "estimated_runtime_seconds": round(estimate_runtime(header, n_threads), 1),
+            "estimated_output_bytes": estimate_output_size(header),
+        })
+
+    memory = sorted((t["estimated_memory_bytes"] for t in tasks), reverse=True)
+    staged_bytes = sorted((t["staged_bytes"] for t in tasks), reverse=True)
+    outputs = sum(t["estimated_output_bytes"] for t in tasks)
+    wall = schedule([t["estimated_runtime_seconds"] for t in tasks], n_workers)
+    peak_memory = sum(memory[:1 if remote else n_workers])
+
+    # extracted inputs, every output twice while it is being archived, and the
+    # echoes of the tasks running at once when they are staged
+    scratch = sum(t["input_bytes"] for t in tasks) + 2 * outputs
+    if staged:
+        scratch += sum(staged_bytes[:n_workers])
+
+    return {
+        "tasks": tasks,
+        "n_workers": n_workers,
+        "threads_per_task": n_threads,
+        "peak_memory_bytes": peak_memory,
+        "runtime_seconds": round(wall, 1),
+        "output_bytes": outputs,
+        "scratch_bytes": scratch,
+        "suggested_slurm": {
+            "slurm-cpu": str(n_cpus),
+            "slurm-ram": format_size(peak_memory * HEADROOM / n_cpus),
+            "slurm-time": str(math.ceil(wall * HEADROOM / 60)),
+        },
+    }
+
+
+def plan_memory(
+    estimates: Dict[str, int], available: int, n_workers: int, n_cpus: int
+) -> Tuple[List[str], List[str]]:
+    """Compare the memory estimates of all tasks with the memory available.
+
+    Args:
+        estimates (dict): estimated peak memory (bytes) of each task
+        available (int): memory (bytes) available to the gear
+        n_workers (int): number of tasks allowed to run at once
+        n_cpus (int): allocated cpus, to express the suggestion per cpu like slurm-ram
+
+    Returns:
+        errors (list[str]): tasks that cannot fit in memory at all
+        warnings (list[str]): suggestions when concurrency will be limited by memory
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+    if not estimates:
+        return errors, warnings
+
+    largest = sorted(estimates.values(), reverse=True)
+    needed_serial = largest[0] * HEADROOM
+    needed_parallel = sum(largest[:n_workers]) * HEADROOM
+
+    for task, estimate in sorted(estimates.items()):
+        log.info("Estimated peak memory of %s: %s", task, format_size(estimate))
+    log.info(
+        "Memory available: %s; suggested slurm-ram (per cpu, %d cpus): %s to run %d task(s) at once, %s minimum",
+        format_size(available), n_cpus, format_size(needed_parallel / n_cpus), min(n_workers, len(largest)),
+        format_size(needed_serial / n_cpus),
+    )
+
+    too_large = [task for task, estimate in estimates.items() if estimate > available]
+    if too_large:
+        errors.append(
+            "Not enough memory for %s: %s needed, %s available. Request at least slurm-ram=%s with slurm-cpu=%d."
+            % (", ".join(sorted(too_large)), format_size(largest[0]), format_size(available),
+               format_size(needed_serial / n_cpus), n_cpus)
+        )
+    elif needed_parallel > available:
+        warnings.append(
+            "Memory limits concurrency: %s available, %s needed to run %d tasks at once. "
+            "Request slurm-ram=%s with slurm-cpu=%d to run them all concurrently."
+            % (format_size(available), format_size(needed_parallel), min(n_workers, len(largest)),
+               format_size(needed_parallel / n_cpus), n_cpus)
+        )
+    return errors, warnings
+
+
+class MemoryBudget:
+    """Admission control: tasks reserve their estimated memory before starting.
+
+    A task waits until its estimate fits in what is left of the budget. A task that
+    is larger than the whole budget may still run, but only on its own.
+
+    Args:
+        total (int): memory (bytes) to share between concurrent tasks
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int):
+        """Block until size bytes can be reserved."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.used == 0 or self.used + size <= self.total)
+            self.used += size
+
+    def release(self, size: int):
+        """Return size bytes to the budget."""
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
@@ -0,0 +1,191 @@
+"""Pre-flight validation of the tedana inputs.
+
+Only NIfTI headers and JSON sidecars are read, so every task of a session is checked
+in seconds, before the first tedana run starts. nibabel and numpy are imported on
+first use, so runs that never read a header do not pay for them at startup.
+"""
+
+import json
+import logging
+import os
+from typing import Dict, List, Tuple
+
+from fw_gear_tedana.bids_index import parse_bids_name
+
+log = logging.getLogger(__name__)
+
+AFFINE_TOLERANCE = 1e-3
+
+
+def read_header(path) -> dict:
+    """Read the geometry of a NIfTI image without loading its voxel data.
+
+    Args:
+        path (str): NIfTI image
+
+    Returns:
+        header (dict): shape, zooms, affine, dtype and itemsize of the image
+    """
+    import nibabel as nib  # pylint: disable=import-outside-toplevel
+
+    img = nib.load(path)
+    dtype = img.header.get_data_dtype()
+    return {
+        "shape": [int(i) for i in img.shape],
+        "zooms": [float(i) for i in img.header.get_zooms()],
+        "affine": img.affine.tolist(),
+        "dtype": str(dtype),
+        "itemsize": int(dtype.itemsize),
+    }
+
+
+def same_affine(affine, other) -> bool:
+    """Return whether two affines (nested lists, as in read_header) match within AFFINE_TOLERANCE."""
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    return np.allclose(affine, other, atol=AFFINE_TOLERANCE)
+
+
+def check_echoes(
+    prefix, echo_files: List[str], sidecars: List[str] = None, echo_times: List[float] = None
+) -> Tuple[List[str], List[str], dict]:
+    """Check that the echoes of one task can be combined by tedana.
+
+    Args:
+        prefix (str): name of the task, used in the messages
+        echo_files (list of str): echo images, ordered by echo number
+        sidecars (list of str): JSON sidecar of each echo (None if missing)
+        echo_times (list of float): echo times (ms) of each echo (None if unknown),
+            instead of reading them from the sidecars
+
+    Returns:
+        errors (list[str]): problems that prevent the run
+        warnings (list[str]): problems that may affect the results
+        header (dict): geometry of the echoes, with "n_echoes", "n_volumes", "tr" and
+            "echo_times" added
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+
+    if len(echo_files) < 2:
+        errors.append(f"{prefix}: found {len(echo_files)} echo, tedana needs at least 2")
+
+    if echo_times is not None:
+        if len(echo_times) != len(echo_files):
+            errors.append(f"{prefix}: {len(echo_times)} echo times for {len(echo_files)} echoes")
+        missing = [os.path.basename(e) for e, t in zip(echo_files, echo_times) if t is None]
+        if missing:
+            errors.append(f"{prefix}: no echo time for {', '.join(missing)}")
+        echo_times = [t for t in echo_times if t is not None]
+    else:
+        echo_times = []
+    for echo, sidecar in zip(echo_files, sidecars or []):
+        if not sidecar:
+            errors.append(f"{prefix}: no JSON sidecar for {os.path.basename(echo)}")
+            continue
+        try:
+            with open(sidecar) as f:
+                echo_times.append(json.load(f)["EchoTime"] * 1000)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            errors.append(f"{prefix}: cannot read EchoTime from {os.path.basename(sidecar)}: {e!r}")
+    if len(set(echo_times)) != len(echo_times):
+        warnings.append(f"{prefix}: repeated echo times {echo_times}")
+    elif echo_times != sorted(echo_times):
+        warnings.append(f"{prefix}: echo times are not increasing with echo number {echo_times}")
+
+    headers = []
+    for echo in echo_files:
+        try:
+            headers.append(read_header(echo))
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(f"{prefix}: cannot read NIfTI header of {os.path.basename(echo)}: {e}")
+    if not headers:
+        return errors, warnings, {}
+
+    first = headers[0]
+    if len(first["shape"]) != 4:
+        errors.append(f"{prefix}: echoes must be 4D images, found shape {first['shape']}")
+    for echo, header in zip(echo_files[1:], headers[1:]):
+        name = os.path.basename(echo)
+        if header["shape"] != first["shape"]:
+            errors.append(f"{prefix}: {name} has shape {header['shape']}, first echo has {first['shape']}")
+        if not same_affine(header["affine"], first["affine"]):
+            errors.append(f"{prefix}: {name} has a different affine than the first echo")
+        if header["zooms"][3:] != first["zooms"][3:]:
+            errors.append(f"{prefix}: {name} has TR {header['zooms'][3:]}, first echo has {first['zooms'][3:]}")
+
+    header = dict(first)
+    header["n_echoes"] = len(echo_files)
+    header["n_volumes"] = first["shape"][3] if len(first["shape"]) > 3 else 1
+    header["tr"] = first["zooms"][3] if len(first["zooms"]) > 3 else None
+    header["echo_times"] = echo_times
+    return errors, warnings, header
+
+
+def check_mask(prefix, mask, header: dict) -> List[str]:
+    """Check that an explicit mask matches the geometry of the echoes.
+
+    Args:
+        prefix (str): name of the task, used in the messages
+        mask (str): mask image, None if it was not found
+        header (dict): geometry of the echoes, from check_echoes
+
+    Returns:
+        errors (list[str]): problems that prevent the run
+    """
+    if not mask:
+        return [f"{prefix}: explicit-mask is set but no brain mask was found"]
+    if not header:
+        return []
+
+    try:
+        mask_header = read_header(mask)
+    except Exception as e:  # pylint: disable=broad-except
+        return [f"{prefix}: cannot read NIfTI header of {os.path.basename(mask)}: {e}"]
+
+    errors = []
+    if mask_header["shape"][:3] != header["shape"][:3]:
+        errors.append(f"{prefix}: mask has shape {mask_header['shape'][:3]}, echoes have {header['shape'][:3]}")
+    elif not same_affine(mask_header["affine"], header["affine"]):
+        errors.append(f"{prefix}: mask has a different affine than the echoes")
+    return errors
+
+
+def check_fmriprep_tasks(index, tasks: List[str], explicit_mask=False) -> Tuple[List[str], List[str], Dict[str, dict]]:
+    """Check every multi-echo task found in an fmriprep func folder.
+
+    Args:
+        index (FuncIndex): index of the fmriprep func folder
+        tasks (list of str): tasks to check
+        explicit_mask (bool): whether a brain mask is required
+
+    Returns:
+        errors (list[str]): problems that prevent the run
+        warnings (list[str]): problems that may affect the results
+        headers (dict): geometry of the echoes of each task, by task
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+    headers: Dict[str, dict] = {}
+
+    if not tasks:
+        errors.append(f"No multi-echo preprocessed bold images found in {index.func_dir}")
+
+    for task in tasks:
+        echo_files = index.echoes(task)
+        task_errors, task_warnings, header = check_echoes(
+            task, echo_files, [index.sidecar(e) for e in echo_files]
+        )
+        if explicit_mask and echo_files:
+            prefix = parse_bids_name(echo_files[0]).prefix
+            task_errors += check_mask(task, index.mask(prefix), header)
+        errors += task_errors
+        warnings += task_warnings
+        headers[task] = header
+
+    n_echoes = {task: header["n_echoes"] for task, header in headers.items() if header}
+    if len(set(n_echoes.values())) > 1:
+        warnings.append(f"Tasks have different numbers of echoes: {n_echoes}")
+
+    log.info("Pre-flight checked %d tasks: %d errors, %d warnings", len(tasks), len(errors), len(warnings))
+    return errors, warnings, headers
@@ -0,0 +1,170 @@
+"""Uncompressed staging of the echo images.
+
+fmriprep writes the echoes gzip-compressed, which nibabel cannot memory-map, so
+every tedana run decompresses them fully into memory. With staging, the echoes of a
+task are decompressed once to plain ``.nii`` files on fast scratch (``/dev/shm``
+when they fit), tedana reads those instead, and the OS page cache can share them
+between concurrent runs. Staged files count against a size budget and are removed
+as soon as their task finishes.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from utils.resources import allocated_bytes, allocated_cpus, format_size, in_memory
+
+log = logging.getLogger(__name__)
+
+SHM_DIR = "/dev/shm"
+STAGING_DIRNAME = "tedana-stage-"
+COPY_BUFSIZE = 1024 * 1024
+
+
+def uncompressed_size(path) -> int:
+    """Return the size (bytes) of a NIfTI image once decompressed, from its header."""
+    import nibabel as nib  # pylint: disable=import-outside-toplevel
+
+    header = nib.load(path).header
+    size = header.get_data_dtype().itemsize
+    for dim in header.get_data_shape():
+        size *= dim
+    return int(header.get_data_offset()) + size
+
+
+def _decompress(item):
+    src, dst = item
+    with gzip.open(src, "rb") as fin, open(dst, "wb") as fout:
+        shutil.copyfileobj(fin, fout, COPY_BUFSIZE)
+    return dst
+
+
+def _free_space(path) -> int:
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return 0
+
+
+class StagingArea:
+    """Decompressed copies of the echo images, shared between the task runs.
+
+    A task waits until its echoes fit in what is left of the budget. A task larger
+    than the whole budget is not staged and reads the compressed echoes.
+
+    Args:
+        root (str): folder to stage into
+        budget (int): bytes that may be staged at once
+    """
+
+    def __init__(self, root, budget: int):
+        self.root = root
+        self.total = budget
+        self.used = 0
+        self._staged = {}
+        self._cond = threading.Condition()
+        # left-overs of an interrupted run
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root)
+
+    @classmethod
+    def from_options(cls, gear_options: dict, task_specs: List[dict]) -> Optional["StagingArea"]:
+        """Create the staging area set up in the gear config.
+
+        /dev/shm is used when the largest task fits in it, the work directory
+        otherwise. The budget is "gear-stage-budget" (GB), or the free space of the
+        chosen folder when 0. When the staged files are held in memory, at most half
+        of the available memory is used, less what the work directory already holds
+        if it is in memory too.
+
+        Returns:
+            staging (StagingArea): None if staging is disabled or this is a dry run
+        """
+        if not gear_options.get("stage-uncompressed") or gear_options["dry-run"]:
+            return None
+
+        largest = max((task_size(spec) for spec in task_specs), default=0)
+        budget_gb = gear_options.get("stage-budget") or 0
+        name = STAGING_DIRNAME + gear_options["destination-id"]
+
+        parent = str(gear_options["work-dir"])
+        if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK) and _free_space(SHM_DIR) > largest:
+            parent = SHM_DIR
+        budget = int(budget_gb * 1024 ** 3) if budget_gb else _free_space(parent)
+        budget = min(budget, _free_space(parent))
+        if in_memory(parent) and gear_options.get("available-memory"):
+            # files in /dev/shm are held in memory: leave at least half of it to tedana,
+            # and share that half with the gear's scratch when it is held in memory too
+            share = gear_options["available-memory"] // 2
+            if in_memory(gear_options["work-dir"]):
+                held = allocated_bytes([gear_options["work-dir"]])
+                log.info("The work directory is held in memory too (%s used)", format_size(held))
+                share -= held
+            budget = min(budget, max(0, share))
+
+        log.info("Staging uncompressed echoes in %s (budget %s, largest task %s)",
+                 parent, format_size(budget), format_size(largest))
+        return cls(os.path.join(parent, name), budget)
+
+    def stage(self, prefix, echo_files: List[str], size: int) -> List[str]:
+        """Decompress the echoes of a task, waiting for room in the budget.
+
+        Args:
+            prefix (str): task being staged
+            echo_files (list of str): compressed echo images
+            size (int): decompressed size of the echoes, see task_size
+
+        Returns:
+            echo_files (list of str): staged images, or the original images if the
+                task cannot be staged
+        """
+        if not any(f.endswith(".gz") for f in echo_files):
+            return echo_files
+        if size > self.total:
+            log.info("Echoes of %s (%s) exceed the staging budget, reading them compressed",
+                     prefix, format_size(size))
+            return echo_files
+
+        with self._cond:
+            self._cond.wait_for(lambda: self.used + size <= self.total)
+            self.used += size
+            self._staged[prefix] = size
+
+        task_dir = os.path.join(self.root, prefix)
+        os.makedirs(task_dir, exist_ok=True)
+        items = []
+        for path in echo_files:
+            name = os.path.basename(path)
+            if name.endswith(".gz"):
+                name = name[:-3]
+            items.append((path, os.path.join(task_dir, name)))
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(items), allocated_cpus())) as pool:
+                staged = list(pool.map(_decompress, items))
+        except Exception:
+            self.release(prefix)
+            raise
+
+        log.info("Staged %d echoes of %s (%s) in %s", len(staged), prefix, format_size(size), task_dir)
+        return staged
+
+    def release(self, prefix):
+        """Remove the staged echoes of a task and return their room to the budget."""
+        shutil.rmtree(os.path.join(self.root, prefix), ignore_errors=True)
+        with self._cond:
+            self.used -= self._staged.pop(prefix, 0)
+            self._cond.notify_all()
+
+    def close(self):
+        """Remove the staging folder."""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def task_size(spec: dict) -> int:
+    """Return the decompressed size (bytes) of the echoes of a task."""
+    return sum(uncompressed_size(f) if f.endswith(".gz") else os.path.getsize(f) for f in spec["echo_files"])
@@ -6,16 +6,19 @@ import os
 import shutil
 import sys
 from pathlib import Path
-
-from flywheel_gear_toolkit import GearToolkitContext
+from typing import TYPE_CHECKING
 
 # This design with the main interfaces separated from a gear module (with main and
 # parser) allows the gear module to be publishable, so it can then be imported in
 # another project, which enables chaining multiple gears together.
+from fw_gear_tedana.batch import run_batch
 from fw_gear_tedana.main import prepare, run
 from fw_gear_tedana.parser import parse_config
 
-from utils.singularity import run_in_tmp_dir
+from utils.singularity import estimate_scratch, run_in_tmp_dir
+
+if TYPE_CHECKING:
+    from flywheel_gear_toolkit import GearToolkitContext
 
 # The gear is split up into 2 main components. The run.py file which is executed
 # when the container runs. The run.py file then imports the rest of the gear as a
@@ -23,11 +26,9 @@ from utils.singularity import run_in_tmp_dir
 
 log = logging.getLogger(__name__)
 
-os.chdir("/flywheel/v0")
-
 
 # pylint: disable=too-many-locals,too-many-statements
-def execute(context: GearToolkitContext):
+def execute(context: "GearToolkitContext"):
     FWV0 = Path.cwd()
     log.info("Running gear in %s", FWV0)
     output_dir = context.output_dir
@@ -39,15 +40,7 @@ def execute(context: GearToolkitContext):
     return_code = 0
 
     """Parses config and runs."""
-    # For now, don't allow runs at the project level:
-    destination = context.client.get(context.destination["id"])
-    if destination.parent.type == "project":
-        log.exception(
-            "This version of the gear does not run at the project level. "
-            "Try running it for each individual subject."
-        )
-        # sys.exit(1)
-        return_code = 1
+    # Runs at the project or subject level process every session below it (batch mode)
 
     # Errors and warnings will always be logged when they are detected.
     # Keep a list of errors and warning to print all in one place at end of log
@@ -77,7 +70,10 @@ def execute(context: GearToolkitContext):
         try:
             # Pass the args, kwargs to fw_gear_qsiprep.main.run function to execute
             # the main functionality of the gear.
-            e_code = run(gear_options, app_options)
+            if app_options.get("inputtype") == "batch":
+                e_code = run_batch(gear_options, app_options)
+            else:
+                e_code = run(gear_options, app_options)
 
 
         except RuntimeError as exc:
@@ -92,20 +88,38 @@ def execute(context: GearToolkitContext):
             # the partial outputs can help pinpoint what the exact problem was. So we
             # have `post_run` further down.
 
-            # save_metadata(context, gear_options["output_analysis_id_dir"] / "qsiprep")
-            pass
+            context.metadata.update_container(
+                "analysis", info={"tedana-metrics": gear_options["metrics"].summary()}
+            )
+
+    # Record where the time went (also for failed runs) for capacity planning
+    gear_options["metrics"].write(
+        os.path.join(output_dir, "tedana_metrics_" + gear_options["destination-id"] + ".json")
+    )
 
     return e_code
 
 
 # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
+    os.chdir("/flywheel/v0")
+
+    # Where the gear runs only depends on config.json, so it is read directly and the
+    # context is built once, in the directory the gear ends up running in.
+    with open("config.json") as f:
+        config_json = json.load(f)
+    logging.basicConfig(level=logging.DEBUG if config_json["config"].get("debug") else logging.INFO)
+    needed = estimate_scratch(
+        inp["location"]["path"] for inp in config_json["inputs"].values() if inp["base"] == "file"
+    )
+    # the elements of a slurm-array job read their inputs from the work directory
+    shared = config_json["config"].get("gear-tedana-engine") == "slurm-array"
+    scratch_dir = run_in_tmp_dir(config_json["config"]["gear-writable-dir"], needed, shared)
+
     # Get access to gear config, inputs, and sdk client if enabled.
-    with GearToolkitContext() as gear_context:
-        scratch_dir = run_in_tmp_dir(gear_context.config["gear-writable-dir"])
-    # Has to be instantiated twice here, since parent directories might have
-    # changed
-    with GearToolkitContext() as gear_context:
+    import flywheel_gear_toolkit  # pylint: disable=import-outside-toplevel
+
+    with flywheel_gear_toolkit.GearToolkitContext() as gear_context:
 
         # # Initialize logging, set logging level based on `debug` configuration
         # # key in gear config.
@@ -0,0 +1,63 @@
+import gzip
+import os
+import zipfile
+
+from utils.archive import gzip_stream, zip_tree
+
+
+def make_tree(root):
+    files = {
+        "empty.txt": b"",
+        "données/résumé.txt": "é ü ß 漢字\n".encode() * 100,
+        "func/sub-01_desc-optcom_bold.nii.gz": gzip.compress(os.urandom(4096)),
+        "func/sub-01_report/report.html": b"<html>tedana</html>\n" * 5000,
+    }
+    for name, content in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    return files
+
+
+def test_zip_tree_writes_a_valid_archive(tmp_path):
+    files = make_tree(tmp_path / "tree")
+    dest = tmp_path / "out.zip"
+
+    stats = zip_tree(str(tmp_path / "tree"), str(dest), arcroot="analysis", n_threads=2)
+
+    assert stats["files"] == len(files)
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted("analysis/" + name for name in files)
+        for name, content in files.items():
+            assert zf.read("analysis/" + name) == content
+        infos = {info.filename: info for info in zf.infolist()}
+    assert infos["analysis/func/sub-01_desc-optcom_bold.nii.gz"].compress_type == zipfile.ZIP_STORED
+    assert infos["analysis/func/sub-01_report/report.html"].compress_type == zipfile.ZIP_DEFLATED
+    assert infos["analysis/empty.txt"].file_size == 0
+
+
+def test_zip_tree_archive_can_be_appended_to(tmp_path):
+    make_tree(tmp_path / "tree")
+    dest = tmp_path / "out.zip"
+    zip_tree(str(tmp_path / "tree"), str(dest))
+
+    # the central directory written by zipfile must account for every member
+    with zipfile.ZipFile(dest, "a") as zf:
+        zf.writestr("extra.txt", b"appended")
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.testzip() is None
+        assert zf.read("extra.txt") == b"appended"
+        assert len(zf.namelist()) == 5
+
+
+def test_gzip_stream_round_trip(tmp_path):
+    data = os.urandom(100_000) + b"\0" * 300_000
+    src = tmp_path / "src.bin"
+    src.write_bytes(data)
+    dest = tmp_path / "dest.gz"
+
+    with open(src, "rb") as f:
+        gzip_stream(f, str(dest), level=1, n_threads=2, block_size=64 * 1024)
+
+    assert gzip.decompress(dest.read_bytes()) == data
@@ -0,0 +1,39 @@
+import pytest
+
+from fw_gear_tedana.cache import ResultCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / "cache"), 1024 ** 3)
+
+
+def make_spec(folder, contents=(b"echo-1", b"echo-2"), **args):
+    folder.mkdir(parents=True, exist_ok=True)
+    echo_files = []
+    for i, content in enumerate(contents, 1):
+        path = folder / ("echo-%d.nii.gz" % i)
+        path.write_bytes(content)
+        echo_files.append(str(path))
+    arg_options = {"d": " ".join(echo_files), "out-dir": str(folder / "out"), "fittype": "loglin"}
+    arg_options.update(args)
+    return {"arg_options": arg_options, "echo_files": echo_files, "echo_times": [0.012, 0.028]}
+
+
+def test_key_depends_on_content_not_paths(cache, tmp_path):
+    assert cache.key(make_spec(tmp_path / "a")) == cache.key(make_spec(tmp_path / "b"))
+
+
+def test_key_ignores_command_line_args_spacing(cache, tmp_path):
+    spec = make_spec(tmp_path / "a", **{"command-line-args": "--tedpca aic --seed 42"})
+    spaced = make_spec(tmp_path / "b", **{"command-line-args": "  --tedpca   aic --seed  42 "})
+    assert cache.key(spec) == cache.key(spaced)
+
+
+@pytest.mark.parametrize("change", [
+    {"contents": (b"echo-1", b"other")},
+    {"fittype": "curvefit"},
+    {"command-line-args": "--tedpca mdl"},
+])
+def test_key_changes_with_the_run(cache, tmp_path, change):
+    assert cache.key(make_spec(tmp_path / "a")) != cache.key(make_spec(tmp_path / "b", **change))
@@ -0,0 +1,52 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from fw_gear_tedana import compact
+
+
+def save(tmp_path, data, dtype, name="map.nii.gz"):
+    img = nib.Nifti1Image(data, np.diag([2.0, 2.0, 3.0, 1.0]))
+    img.header.set_data_dtype(dtype)
+    path = str(tmp_path / name)
+    nib.save(img, path)
+    return path, img
+
+
+@pytest.fixture(autouse=True)
+def small_slabs(monkeypatch):
+    # several slabs per image, so the slab boundaries are exercised
+    monkeypatch.setattr(compact, "CHUNK_VALUES", 100)
+
+
+@pytest.mark.parametrize("shape", [(6, 5, 4), (6, 5, 4, 7)])
+def test_downcast_writes_float32(tmp_path, shape):
+    data = np.random.default_rng(0).random(shape) * 100
+    data.flat[3] = np.nan
+    path, img = save(tmp_path, data, np.float64)
+    dest = str(tmp_path / "map.float32.nii")
+
+    assert compact.downcast(path, dest)
+
+    out = nib.load(dest)
+    assert out.get_data_dtype() == np.float32
+    assert out.shape == shape
+    np.testing.assert_allclose(out.get_fdata(), data, rtol=compact.DOWNCAST_RTOL, equal_nan=True)
+    np.testing.assert_array_equal(out.affine, img.affine)
+
+
+def test_downcast_keeps_maps_that_do_not_fit(tmp_path):
+    data = np.random.default_rng(0).random((6, 5, 4)) * 1e40
+    path, _ = save(tmp_path, data, np.float64)
+    dest = tmp_path / "map.float32.nii"
+
+    assert not compact.downcast(path, str(dest))
+    assert not dest.exists()
+
+
+def test_downcast_skips_other_types(tmp_path):
+    path, _ = save(tmp_path, np.ones((4, 4, 4), dtype=np.int16), np.int16)
+    dest = tmp_path / "map.float32.nii"
+
+    assert not compact.downcast(path, str(dest))
+    assert not dest.exists()
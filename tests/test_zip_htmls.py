@@ -0,0 +1,20 @@
+from utils.zip_htmls import flatten_image_refs
+
+
+def test_flatten_image_refs_embeds_only_report_figures(tmp_path):
+    (tmp_path / "figures").mkdir()
+    (tmp_path / "figures" / "a.png").write_bytes(b"png")
+    report = tmp_path / "report.html"
+    report.write_text(
+        '<img src="./figures/a.png"><div style="background: url(figures/a.png)"></div>'
+        '<img src="myfigures/a.png"><img src="figures/missing.png">',
+        encoding="utf-8",
+    )
+
+    dest = flatten_image_refs(report, tmp_path / "flat.html", n_threads=1)
+
+    html = (tmp_path / "flat.html").read_text(encoding="utf-8")
+    assert dest == tmp_path / "flat.html"
+    assert html.count("data:image/png;base64,cG5n") == 2
+    assert 'src="myfigures/a.png"' in html
+    assert 'src="figures/missing.png"' in html
@@ -0,0 +1,304 @@
+"""Write zip archives in-process, compressing several members at once.
+
+Members are compressed by worker threads (zlib releases the GIL) into spooled
+temporary files, then copied into the archive in order by a single writer. Files
+that are already compressed (e.g. ``.nii.gz`` and ``.png``) are stored as they are.
+
+Examples:
+    >>> stats = zip_tree("work/analysis-id", "output/results.zip", arcroot="analysis-id")
+"""
+
+import contextlib
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from utils.resources import allocated_cpus
+
+log = logging.getLogger(__name__)
+
+# recompressing these does not make them any smaller
+STORED_EXTENSIONS = (".gz", ".tgz", ".zip", ".bz2", ".xz", ".png", ".jpg", ".jpeg", ".gif", ".svgz")
+
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Member:
+    """An archive member whose CRC and compressed data are ready to be written.
+
+    Args:
+        zinfo (ZipInfo): header of the member, with CRC and sizes filled in
+        path (str): source file, for stored members
+        data (file): spooled compressed data, for deflated members
+    """
+
+    def __init__(self, zinfo: ZipInfo, path=None, data=None):
+        self.zinfo = zinfo
+        self.path = path
+        self.data = data
+
+    def copy_to(self, fp):
+        """Copy the (compressed) data of the member to an open file."""
+        if self.data is not None:
+            self.data.seek(0)
+            shutil.copyfileobj(self.data, fp, CHUNK_SIZE)
+        else:
+            with open(self.path, "rb") as src:
+                shutil.copyfileobj(src, fp, CHUNK_SIZE)
+
+    def release(self):
+        """Drop the compressed data."""
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+def compress_member(path, arcname, level=6) -> Member:
+    """Prepare a file for the archive: compute its CRC and compress it if worthwhile.
+
+    Args:
+        path (str): file to add
+        arcname (str): name of the member in the archive
+        level (int): zlib compression level
+
+    Returns:
+        Member: the prepared member
+    """
+    zinfo = ZipInfo.from_file(path, arcname)
+    crc = 0
+
+    if path.lower().endswith(STORED_EXTENSIONS):
+        zinfo.compress_type = ZIP_STORED
+        with open(path, "rb") as src:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+        zinfo.CRC = crc
+        zinfo.compress_size = zinfo.file_size
+        return Member(zinfo, path=path)
+
+    zinfo.compress_type = ZIP_DEFLATED
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            data.write(compressor.compress(chunk))
+    data.write(compressor.flush())
+    zinfo.CRC = crc
+    zinfo.compress_size = data.tell()
+    return Member(zinfo, data=data)
+
+
+def write_member(zf: ZipFile, member: Member):
+    """Append a prepared member to an archive opened for writing.
+
+    This mirrors what ZipFile.write does after compressing, so the central directory
+    (including zip64 records) is still written by zipfile when the archive is closed.
+    """
+    # copy the header, so a prepared member can be written into several archives
+    zinfo = copy.copy(member.zinfo)
+    zf._writecheck(zinfo)  # pylint: disable=protected-access
+    zf._didModify = True  # pylint: disable=protected-access
+    zinfo.header_offset = zf.fp.tell()
+    zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+    zf.fp.write(zinfo.FileHeader(zip64))
+    member.copy_to(zf.fp)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+
+def tree_files(root, arcroot=None):
+    """List the files below a folder with their archive names, in a stable order.
+
+    Args:
+        root (str): folder to archive
+        arcroot (str, optional): prefix of the archive names. Defaults to none.
+
+    Returns:
+        list of (path, arcname) tuples
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            arcname = os.path.relpath(path, root).replace(os.sep, "/")
+            if arcroot:
+                arcname = arcroot + "/" + arcname
+            files.append((path, arcname))
+    return files
+
+
+def zip_files(files, dest_zip, n_threads=None, level=6) -> dict:
+    """Write the given files into a zip archive, compressing them in parallel.
+
+    Args:
+        files (list): (path, arcname) tuples, written in this order
+        dest_zip (str): archive to create
+        n_threads (int, optional): number of compression threads. Defaults to the
+            allocated cpus.
+        level (int): zlib compression level
+
+    Returns:
+        stats (dict): number of files, bytes read and written, seconds and MB/s
+    """
+    n_threads = n_threads or allocated_cpus()
+    start = time.monotonic()
+    bytes_in = 0
+
+    # bound the number of members held in spooled files at any time
+    window = 2 * n_threads
+    pending = deque()
+    todo = iter(files)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool, ZipFile(dest_zip, "w", allowZip64=True) as zf:
+        while True:
+            while len(pending) < window:
+                item = next(todo, None)
+                if item is None:
+                    break
+                pending.append(pool.submit(compress_member, item[0], item[1], level))
+            if not pending:
+                break
+            member = pending.popleft().result()
+            write_member(zf, member)
+            bytes_in += member.zinfo.file_size
+            member.release()
+
+    seconds = time.monotonic() - start
+    bytes_out = os.path.getsize(dest_zip)
+    stats = {
+        "files": len(files),
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(bytes_in / 1e6 / seconds, 1) if seconds else None,
+    }
+    log.info(
+        "Wrote %s: %d files, %.1f MB -> %.1f MB in %.1f s (%.1f MB/s)",
+        dest_zip, stats["files"], bytes_in / 1e6, bytes_out / 1e6, seconds, stats["mb_per_s"] or 0,
+    )
+    return stats
+
+
+def zip_tree(root, dest_zip, arcroot=None, n_threads=None, level=6) -> dict:
+    """Archive a folder, like ``zip -r``, compressing members in parallel.
+
+    Args:
+        root (str): folder to archive
+        dest_zip (str): archive to create
+        arcroot (str, optional): prefix of the archive names. Defaults to none.
+        n_threads (int, optional): number of compression threads. Defaults to the
+            allocated cpus.
+        level (int): zlib compression level
+
+    Returns:
+        stats (dict): see zip_files
+    """
+    return zip_files(tree_files(root, arcroot), dest_zip, n_threads=n_threads, level=level)
+
+
+def gzip_stream(src, dest_path, level=6, n_threads=None, block_size=GZIP_BLOCK_SIZE) -> int:
+    """Gzip a stream in parallel, as consecutive gzip members of block_size bytes each.
+
+    Concatenated members are a valid gzip file (RFC 1952), read like a single one by
+    gzip, zlib and nibabel; splitting the input lets every block be compressed by its
+    own thread, like pigz.
+
+    Args:
+        src (file): binary stream to compress, read to its end
+        dest_path (str): .gz file to create
+        level (int): zlib compression level
+        n_threads (int, optional): number of compression threads. Defaults to the
+            allocated cpus.
+        block_size (int): uncompressed bytes per member
+
+    Returns:
+        bytes_in (int): number of bytes compressed
+    """
+
+    def _compress(block):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: with gzip header and trailer
+        return compressor.compress(block) + compressor.flush()
+
+    n_threads = n_threads or allocated_cpus()
+    bytes_in = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_threads) as pool, open(dest_path, "wb") as dest:
+        while True:
+            # bound the number of blocks held in memory at any time
+            while len(pending) < 2 * n_threads:
+                block = src.read(block_size)
+                if not block:
+                    break
+                bytes_in += len(block)
+                pending.append(pool.submit(_compress, block))
+            if not pending:
+                break
+            dest.write(pending.popleft().result())
+    return bytes_in
+
+
+class BackgroundArchiver:
+    """Write archives one after the other in a background thread.
+
+    Archives are submitted while other work continues (e.g. the next tedana run),
+    so compression overlaps with compute instead of running after it.
+
+    Args:
+        n_threads (int): compression threads of each archive
+        level (int): zlib compression level
+    """
+
+    def __init__(self, n_threads=2, level=6):
+        self.n_threads = n_threads
+        self.level = level
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archiver")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, files, dest_zip, phase=None, callback=None):
+        """Queue an archive.
+
+        Args:
+            name (str): key of the archive in the results of wait()
+            files (list): (path, arcname) tuples, see zip_files
+            dest_zip (str): archive to create
+            phase (callable, optional): returns a context manager measuring the
+                write, whose value is updated with the stats (e.g. a Metrics phase)
+            callback (callable, optional): called with the stats once written
+        """
+
+        def _write():
+            with phase() if phase else contextlib.nullcontext({}) as record:
+                stats = zip_files(files, dest_zip, n_threads=self.n_threads, level=self.level)
+                record.update(stats)
+            if callback:
+                callback(stats)
+            return stats
+
+        with self._lock:
+            self._futures[name] = self._executor.submit(_write)
+
+    def wait(self) -> dict:
+        """Wait for all queued archives.
+
+        Returns:
+            failures (dict): exception of each archive that could not be written, by name
+        """
+        with self._lock:
+            futures = dict(self._futures)
+        wait(list(futures.values()))
+        self._executor.shutdown()
+        return {name: f.exception() for name, f in futures.items() if f.exception() is not None}
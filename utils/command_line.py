@@ -34,9 +34,14 @@ built from gear configuration options.
 
 import logging
 import subprocess as sp
+import threading
+from collections import deque
 
 log = logging.getLogger(__name__)
 
+# lines of stdout and stderr kept in memory for error reporting
+TAIL_LINES = 200
+
 
 def _remove_prohibited_values(param_list):
     """
@@ -117,6 +122,8 @@ def exec_command(
     stdout_msg=None,
     cont_output=False,
     cwd=None,
+    tag=None,
+    log_path=None,
 ):
     """
     An abstraction to execute prepared shell commands using the subprocess module.
@@ -136,8 +143,14 @@ def exec_command(
         cont_output (bool, optional): Used to provide continuous output of
             stdout without waiting until the completion of the shell command.
             Defaults to False.
+        cwd (str, optional): working directory of the command.
+        tag (str, optional): with cont_output, prepended to every output line so the
+            output of concurrent commands can be told apart.
+        log_path (str, optional): with cont_output, file receiving the complete
+            stdout and stderr of the command.
     Returns:
-        stdout, stderr, returncode
+        stdout, stderr, returncode. With cont_output, only the last TAIL_LINES lines
+        of stdout and stderr are returned.
     Raises:
         RuntimeError: If the return value from the command-line function is not zero.
 
@@ -175,15 +188,8 @@ def exec_command(
 
         # if continuous stdout is desired... and we are not redirecting output
         if cont_output and not (shell and (">" in command)) and (stdout_msg is None):
-            while True:
-                stdout = result.stdout.readline()
-                if stdout == "" and result.poll() is not None:
-                    break
-                if stdout:
-                    print(stdout.rstrip())
-
-            returncode = result.poll()
-            stderr = "".join(result.stderr.readlines())
+            stdout, stderr = stream_output(result, tag=tag, log_path=log_path)
+            returncode = result.wait()
         else:
             stdout, stderr = result.communicate()
 
@@ -195,9 +201,63 @@ def exec_command(
 
         if returncode != 0:
             log.error(stderr)
+            if log_path:
+                log.error("Complete output of the command: %s", log_path)
             raise RuntimeError("The following command has failed: \n{}".format(command))
     else:
         log.info("Dry run mode set.")
         stdout = None; stderr = None; returncode = 0
 
     return stdout, stderr, returncode
+
+
+def _drain(pipe, tag, tail, log_file, lock):
+    """Forward the lines of a pipe to the log, the log file and a bounded tail."""
+    for line in iter(pipe.readline, ""):
+        line = line.rstrip("\n")
+        tail.append(line)
+        if log_file:
+            with lock:
+                log_file.write(line + "\n")
+        if tag:
+            log.info("[%s] %s", tag, line)
+        else:
+            log.info(line)
+    pipe.close()
+
+
+def stream_output(process, tag=None, log_path=None, tail_lines=TAIL_LINES):
+    """Read the stdout and stderr of a running process concurrently, until it exits.
+
+    Each pipe is drained by its own thread, so a command writing a lot to stderr
+    never blocks on a full pipe. Lines are logged as they arrive (one log record per
+    line, so the output of concurrent commands does not interleave mid-line).
+
+    Args:
+        process (Popen): process started with text-mode stdout and stderr pipes
+        tag (str, optional): prepended to every logged line
+        log_path (str, optional): file receiving the complete output
+        tail_lines (int, optional): number of lines of each stream to keep
+
+    Returns:
+        stdout, stderr: the last tail_lines lines of each stream
+    """
+    tails = {"stdout": deque(maxlen=tail_lines), "stderr": deque(maxlen=tail_lines)}
+    lock = threading.Lock()
+    log_file = open(log_path, "w", buffering=1) if log_path else None
+    try:
+        threads = [
+            threading.Thread(
+                target=_drain, args=(getattr(process, name), tag, tail, log_file, lock), daemon=True
+            )
+            for name, tail in tails.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if log_file:
+            log_file.close()
+
+    return "\n".join(tails["stdout"]), "\n".join(tails["stderr"])
@@ -0,0 +1,203 @@
+"""Per-phase timing and resource instrumentation.
+
+Each phase records its wall time, cpu time, peak resident memory and bytes read and
+written, for the gear process and all of its child processes (tedana runs). When
+folders are watched (see Metrics.watch_disk), the bytes they hold on disk are
+measured at the start and end of every phase, and the peak is reported. The
+resource counters are process wide, so when phases run concurrently (e.g. several
+tedana tasks) each phase is charged with everything that happened during it.
+
+Examples:
+    >>> metrics = Metrics()
+    >>> with metrics.phase("extract"):
+    ...     unzip()
+    >>> metrics.write("output/metrics.json")
+"""
+
+import contextlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+import psutil
+
+from utils.resources import allocated_bytes
+
+log = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.5
+
+
+def _tree():
+    """Return the gear process and its live descendants."""
+    proc = psutil.Process()
+    try:
+        return [proc] + proc.children(recursive=True)
+    except psutil.Error:
+        return [proc]
+
+
+def _rss(procs):
+    total = 0
+    for proc in procs:
+        try:
+            total += proc.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def _counters():
+    """Snapshot the cpu seconds and storage bytes of this process and its children.
+
+    Live processes are counted by pid; children that already exited are counted
+    through the rusage of reaped children.
+    """
+    per_pid = {}
+    for proc in _tree():
+        try:
+            cpu = proc.cpu_times()
+            io = proc.io_counters()
+            per_pid[proc.pid] = (cpu.user + cpu.system, io.read_bytes, io.write_bytes)
+        except (psutil.Error, AttributeError):
+            pass
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    reaped = (children.ru_utime + children.ru_stime, children.ru_inblock * 512, children.ru_oublock * 512)
+    return per_pid, reaped
+
+
+def _delta(start, end):
+    (start_pids, start_reaped), (end_pids, end_reaped) = start, end
+    totals = [e - s for s, e in zip(start_reaped, end_reaped)]
+    for pid, values in end_pids.items():
+        before = start_pids.get(pid, (0, 0, 0))
+        for i, (s, e) in enumerate(zip(before, values)):
+            totals[i] += max(0, e - s)
+    return totals
+
+
+class Metrics:
+    """Collect per-phase metrics for a gear run, per task and for the session."""
+
+    def __init__(self):
+        self.phases = []
+        self._active = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._start = time.time()
+        self.disk_paths = []
+        self.peak_disk = 0
+
+    def watch_disk(self, *paths):
+        """Measure the bytes held on disk below these folders at every phase boundary."""
+        self.disk_paths.extend(str(p) for p in paths)
+        self.disk_bytes()
+
+    def disk_bytes(self) -> int:
+        """Measure the watched folders now, and update the peak."""
+        if not self.disk_paths:
+            return 0
+        size = allocated_bytes(self.disk_paths)
+        with self._lock:
+            self.peak_disk = max(self.peak_disk, size)
+        return size
+
+    @contextlib.contextmanager
+    def phase(self, name, task=None):
+        """Measure the enclosed block as a phase.
+
+        Args:
+            name (str): phase name, e.g. "extract" or "tedana"
+            task (str, optional): task the phase belongs to; None for session phases
+        """
+        record = {"phase": name, "task": task, "start": time.time(), "peak_rss": _rss(_tree())}
+        self.disk_bytes()
+        start_counters = _counters()
+        start = time.monotonic()
+        with self._lock:
+            self._active.append(record)
+            self._ensure_sampler()
+        try:
+            yield record
+        finally:
+            seconds = time.monotonic() - start
+            cpu, read_bytes, write_bytes = _delta(start_counters, _counters())
+            disk_bytes = self.disk_bytes()
+            with self._lock:
+                self._active.remove(record)
+                record.update(
+                    seconds=round(seconds, 3),
+                    cpu_seconds=round(cpu, 3),
+                    peak_rss=max(record["peak_rss"], _rss(_tree())),
+                    read_bytes=read_bytes,
+                    write_bytes=write_bytes,
+                    disk_bytes=disk_bytes,
+                )
+                self.phases.append(record)
+            log.debug("Phase %s%s: %.1f s", name, " (%s)" % task if task else "", seconds)
+
+    def _ensure_sampler(self):
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._sample, name="metrics-sampler", daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        """Track the peak memory of the active phases, until none is left."""
+        while True:
+            rss = _rss(_tree())
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                for record in self._active:
+                    record["peak_rss"] = max(record["peak_rss"], rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def summary(self) -> dict:
+        """Return the phases grouped per task and totalled for the session."""
+        with self._lock:
+            phases = list(self.phases)
+
+        session = {}
+        tasks = {}
+        for record in phases:
+            total = session.setdefault(
+                record["phase"],
+                {"seconds": 0, "cpu_seconds": 0, "peak_rss": 0, "read_bytes": 0, "write_bytes": 0, "count": 0},
+            )
+            total["count"] += 1
+            total["peak_rss"] = max(total["peak_rss"], record["peak_rss"])
+            for key in ("seconds", "cpu_seconds", "read_bytes", "write_bytes"):
+                total[key] += record[key]
+            if record["task"]:
+                tasks.setdefault(record["task"], {})[record["phase"]] = {
+                    k: v for k, v in record.items() if k not in ("phase", "task")
+                }
+
+        for total in session.values():
+            total["seconds"] = round(total["seconds"], 3)
+            total["cpu_seconds"] = round(total["cpu_seconds"], 3)
+
+        return {
+            "wall_seconds": round(time.time() - self._start, 3),
+            "peak_rss": max([r["peak_rss"] for r in phases], default=0),
+            "peak_disk_bytes": self.peak_disk,
+            "session": session,
+            "tasks": tasks,
+        }
+
+    def write(self, path) -> dict:
+        """Write the summary to a JSON file.
+
+        Returns:
+            summary (dict): what was written
+        """
+        summary = self.summary()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        log.info("Wrote metrics to %s", path)
+        return summary
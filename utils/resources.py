@@ -0,0 +1,153 @@
+"""Query the compute resources allocated to the gear.
+"""
+
+import logging
+import math
+import os
+from pathlib import Path
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+
+# filesystems whose files are held in memory
+MEMORY_FILESYSTEMS = ("tmpfs", "ramfs")
+
+
+def allocated_cpus():
+    """Return the number of cpu-cores this process is allowed to use.
+
+    The affinity mask reflects a SLURM (or taskset) allocation, and a cgroup cpu quota
+    (e.g. docker --cpus) can further restrict it.
+
+    Returns:
+        n_cpus (int): number of usable cpu-cores (at least 1)
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+
+    if os.environ.get("SLURM_CPUS_PER_TASK", "").isdigit():
+        n_cpus = min(n_cpus, int(os.environ["SLURM_CPUS_PER_TASK"]))
+
+    cpu_max = Path("/sys/fs/cgroup/cpu.max")
+    if cpu_max.exists():
+        try:
+            quota, period = cpu_max.read_text().split()
+            if quota != "max":
+                n_cpus = min(n_cpus, math.ceil(int(quota) / int(period)))
+        except (OSError, ValueError) as e:
+            log.debug("Could not read %s: %s", cpu_max, e)
+
+    return max(1, n_cpus)
+
+
+def parse_size(size):
+    """Convert a memory size such as "12G" or "500M" (SLURM style) to bytes.
+
+    Args:
+        size (str): number with an optional K, M, G or T suffix (default unit: M)
+
+    Returns:
+        size_bytes (int): size in bytes
+    """
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size) * units["M"])
+
+
+def format_size(size_bytes):
+    """Format a number of bytes as a SLURM memory size, rounded up to whole units."""
+    for unit, scale in (("T", 1024 ** 4), ("G", 1024 ** 3)):
+        if size_bytes >= scale:
+            return "%d%s" % (math.ceil(size_bytes / scale), unit)
+    return "%dM" % math.ceil(size_bytes / 1024 ** 2)
+
+
+def allocated_bytes(paths):
+    """Return the bytes allocated on disk by the files below the given folders."""
+    total = 0
+    stack = [str(p) for p in paths]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def in_memory(path):
+    """Return whether the files below path are held in memory (tmpfs, such as /dev/shm)."""
+    real = os.path.realpath(str(path))
+    mount_point, fs_type = "", ""
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                point = fields[1].replace("\\040", " ")
+                below = real == point or real.startswith(point.rstrip("/") + "/")
+                if below and len(point) >= len(mount_point):
+                    mount_point, fs_type = point, fields[2]
+    except OSError:
+        return real.startswith("/dev/shm")
+    return fs_type in MEMORY_FILESYSTEMS
+
+
+def _read_limit(path):
+    try:
+        value = Path(path).read_text().strip()
+    except OSError:
+        return None
+    if not value.isdigit():  # "max"
+        return None
+    # cgroup v1 reports "no limit" as a huge number
+    return int(value) if int(value) < 2 ** 60 else None
+
+
+def available_memory(slurm_ram=None, slurm_cpu=None):
+    """Return the memory (bytes) the gear may use, and where that limit comes from.
+
+    The smallest of these limits is used: the cgroup memory limit, the SLURM job
+    allocation (from the environment, or the slurm-ram and slurm-cpu config inside a
+    SLURM job) and the memory available on the machine.
+
+    Args:
+        slurm_ram (str, optional): slurm-ram config (memory per cpu)
+        slurm_cpu (str, optional): slurm-cpu config (cpus per task)
+
+    Returns:
+        available (int): memory in bytes
+        source (str): description of the limiting resource
+    """
+    limits = {"available system memory": psutil.virtual_memory().available}
+
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = _read_limit(path)
+        if limit:
+            limits["cgroup limit"] = limit
+            break
+
+    env = os.environ
+    if env.get("SLURM_MEM_PER_NODE", "").isdigit():
+        limits["SLURM_MEM_PER_NODE"] = int(env["SLURM_MEM_PER_NODE"]) * 1024 ** 2
+    elif env.get("SLURM_MEM_PER_CPU", "").isdigit():
+        limits["SLURM_MEM_PER_CPU"] = int(env["SLURM_MEM_PER_CPU"]) * 1024 ** 2 * allocated_cpus()
+    elif "SLURM_JOB_ID" in env and slurm_ram:
+        limits["slurm-ram"] = parse_size(slurm_ram) * int(slurm_cpu or 1)
+
+    source = min(limits, key=limits.get)
+    return limits[source], source
@@ -6,21 +6,133 @@ import os
 import re
 import shutil
 import tempfile
+import time
 from pathlib import Path
 
+from utils.resources import available_memory, format_size, in_memory
+
 log = logging.getLogger(__name__)
 
 
 FWV0 = "/flywheel/v0"
 SCRATCH_NAME = "gear-temp-dir-"
 
+# node-local scratch locations, tried before gear-writable-dir (environment variables
+# or paths)
+SCRATCH_CANDIDATES = ["TMPDIR", "SLURM_TMPDIR", "/dev/shm", "/tmp"]
+# scratch space needed relative to the size of the inputs: extracted inputs, tedana
+# output maps and the output archive
+SCRATCH_MULTIPLIER = 4
+# bytes written to rank the candidates by throughput
+PROBE_BYTES = 16 * 1024 * 1024
+
+
+def estimate_scratch(input_paths):
+    """Estimate the scratch space (bytes) needed to process the given inputs.
+
+    Returns:
+        needed (int): bytes, or None without file inputs (batch mode downloads its
+        inputs later, so the space it needs is unknown)
+    """
+    sizes = [os.path.getsize(p) for p in input_paths if p and os.path.isfile(p)]
+    if not sizes:
+        return None
+    return SCRATCH_MULTIPLIER * sum(sizes)
+
+
+def probe_throughput(path):
+    """Measure the write throughput (MB/s) of a folder by writing and syncing a file."""
+    chunk = os.urandom(1024 * 1024)
+    fd, probe = tempfile.mkstemp(prefix=".scratch-probe-", dir=path)
+    try:
+        start = time.monotonic()
+        with os.fdopen(fd, "wb") as f:
+            for _ in range(PROBE_BYTES // len(chunk)):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        return PROBE_BYTES / 1e6 / max(time.monotonic() - start, 1e-6)
+    finally:
+        os.remove(probe)
 
-def run_in_tmp_dir(writable_dir):
+
+def _capacity(path):
+    free = shutil.disk_usage(path).free
+    if in_memory(path):
+        # files in /dev/shm are held in memory: leave at least half of it to tedana
+        free = min(free, available_memory()[0] // 2)
+    return free
+
+
+def select_scratch(writable_dir, needed_bytes=0, shared=False):
+    """Choose where to put the gear's scratch directory.
+
+    The node-local SCRATCH_CANDIDATES and writable_dir are considered. Among those
+    that exist, are writable and have room for needed_bytes, the one with the
+    highest write throughput is chosen. writable_dir is used if none has room.
+
+    Args:
+        writable_dir (str): gear-writable-dir
+        needed_bytes (int): scratch space needed, see estimate_scratch. When it is
+            unknown (None), folders held in memory are not considered
+        shared (bool): the scratch must be visible to other nodes, so only
+            writable_dir is considered
+
+    Returns:
+        path (str): folder to create the scratch directory in
+        reason (str): why it was chosen
+    """
+    if shared:
+        return writable_dir, "the compute nodes need to see it, node-local scratch is not considered"
+
+    paths = [os.environ.get(c) if not c.startswith("/") else c for c in SCRATCH_CANDIDATES] + [writable_dir]
+
+    unknown = needed_bytes is None
+    needed_bytes = needed_bytes or 0
+
+    seen = set()
+    candidates = []
+    for path in paths:
+        if not path or not os.path.isdir(path) or not os.access(path, os.W_OK):
+            continue
+        real = os.path.realpath(path)
+        if real in seen:
+            continue
+        seen.add(real)
+        if unknown and in_memory(path):
+            log.info("Scratch candidate %s is held in memory and the space needed is unknown, skipped", path)
+            continue
+        try:
+            capacity = _capacity(path)
+            if capacity < needed_bytes:
+                log.info("Scratch candidate %s: %s free, %s needed", path, format_size(capacity),
+                         format_size(needed_bytes))
+                continue
+            speed = probe_throughput(path)
+        except OSError as e:
+            log.info("Scratch candidate %s is not usable: %s", path, e)
+            continue
+        log.info("Scratch candidate %s: %s free, %.0f MB/s", path, format_size(capacity), speed)
+        candidates.append((speed, path, capacity))
+
+    needed = "unknown space" if unknown else format_size(needed_bytes)
+    if not candidates:
+        return writable_dir, "no candidate has %s free" % needed
+
+    speed, path, capacity = max(candidates)
+    return path, "fastest candidate with room (%.0f MB/s, %s free, %s needed)" % (
+        speed, format_size(capacity), needed)
+
+
+def run_in_tmp_dir(writable_dir, needed_bytes=0, shared=False):
     """Copy gear to a temporary directory and cd to there.
 
     Args:
         writable_dir (string): directory to use for temporary files if /flywheel/v0 is not
             writable.
+        needed_bytes (int): scratch space needed, to choose a node-local scratch
+            location with enough room; None if unknown (see select_scratch)
+        shared (bool): only use writable_dir, which other nodes can see (see select_scratch)
 
     Returns:
         tmp_path (path) The path to the temporary directory so it can be deleted
@@ -60,8 +172,9 @@ def run_in_tmp_dir(writable_dir):
     # be deleted mid-run.  A very confusing error to debug!
 
     # Create temporary place to run gear
-    WD = tempfile.mkdtemp(prefix=SCRATCH_NAME, dir=writable_dir)
-    log.debug("Gear scratch directory is %s", WD)
+    scratch_parent, reason = select_scratch(writable_dir, needed_bytes, shared)
+    WD = tempfile.mkdtemp(prefix=SCRATCH_NAME, dir=scratch_parent)
+    log.info("Gear scratch directory is %s: %s", WD, reason)
 
     new_FWV0 = Path(WD + FWV0)
     new_FWV0.mkdir(parents=True)
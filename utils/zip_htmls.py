@@ -1,23 +1,28 @@
-"""Compress HTML files."""
+"""Compress HTML reports, or embed their figures to make them self-contained."""
 
-import datetime
 import glob
 import logging
 import os
-import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from bs4 import BeautifulSoup
+from zipfile import ZipFile
 import base64
+import mimetypes
 import re
 
-FWV0 = Path.cwd()
+from utils.archive import compress_member, tree_files, write_member
+from utils.resources import allocated_cpus
+
 log = logging.getLogger(__name__)
 
 
-def zip_it_zip_it_good(output_dir, destination_id, name, path):
+def zip_it_zip_it_good(output_dir, destination_id, name, html_member, figure_members):
     """Compress html file into an appropriately named archive file *.html.zip
     files are automatically shown in another tab in the browser. These are
-    saved at the top level of the output folder."""
+    saved at the top level of the output folder.
+
+    The html file is stored as "index.html" next to the already compressed figures,
+    so nothing has to be renamed on disk."""
 
     name_no_html = name[:-5]  # remove ".html" from end
 
@@ -27,96 +32,147 @@ def zip_it_zip_it_good(output_dir, destination_id, name, path):
 
     log.debug('Creating viewable archive "' + dest_zip + '"')
 
-    command = ["zip", "-q", "-r", dest_zip, "index.html"]
-
-    # find all directories called 'figures' and add them to the archive
-    for root, dirs, files in os.walk(path):
-        common_prefix = os.path.commonprefix([path, root])
-        relpath = os.path.relpath(root, common_prefix)
-
-        for name in dirs:
-            if name == "figures":
-                figures_path = os.path.join(relpath, "figures")
-                command.append(figures_path)
-                log.info(f"including {figures_path}")
+    with ZipFile(dest_zip, "w", allowZip64=True) as zf:
+        write_member(zf, html_member)
+        for member in figure_members:
+            write_member(zf, member)
 
-    # log command as a string separated by spaces
-    log.debug(f"pwd = %s", Path.cwd())
-    log.debug(" ".join(command))
+    return dest_zip
 
-    result = sp.run(command, check=True)
 
-
-def zip_htmls(output_dir, destination_id, path):
+def zip_htmls(output_dir, destination_id, path, n_threads=None):
     """Zip all .html files at the given path so they can be displayed
     on the Flywheel platform.
-    Each html file must be converted into an archive individually:
-      rename each to be "index.html", then create a zip archive from it.
+    Each html file must be converted into an archive individually, as
+    "index.html" together with every "figures" folder below the path.
+    The figures are compressed once and the same compressed data is reused
+    in every archive. The working directory is never changed, so this is safe
+    to call from concurrent threads.
+
+    Returns the paths of the archives that were written.
     """
 
     log.info("Creating viewable archives for all html files")
 
-    if os.path.exists(path):
+    if not os.path.exists(path):
+        log.error("Path NOT found: " + str(path))
+        return []
 
-        log.debug("Found path: " + str(path))
+    log.debug("Found path: " + str(path))
 
-        os.chdir(path)
+    html_files = sorted(glob.glob(os.path.join(glob.escape(str(path)), "*.html")))
 
-        html_files = glob.glob("*.html")
+    if len(html_files) == 0:
+        log.warning("No *.html files at " + str(path))
+        return []
 
-        if len(html_files) > 0:
+    # find all directories called 'figures' and add them to the archive
+    figures = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in dirs:
+            if name == "figures":
+                figures_path = os.path.normpath(os.path.relpath(os.path.join(root, name), path))
+                log.info(f"including {figures_path}")
+                figures.extend(tree_files(os.path.join(root, name), figures_path.replace(os.sep, "/")))
 
-            # if there is an index.html, do it first and re-name it for safe
-            # keeping
-            save_name = ""
-            if os.path.exists("index.html"):
-                log.info("Found index.html")
-                zip_it_zip_it_good(output_dir, destination_id, "index.html", path)
+    n_threads = n_threads or min(4, allocated_cpus())
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        figure_members = list(pool.map(lambda f: compress_member(*f), figures))
 
-                now = datetime.datetime.now()
-                save_name = now.strftime("%Y-%m-%d_%H-%M-%S") + "_index.html"
-                os.rename("index.html", save_name)
+    archives = []
+    try:
+        for h_file in html_files:
+            name = os.path.basename(h_file)
+            log.info("Found %s", name)
+            html_member = compress_member(h_file, "index.html")
+            archives.append(zip_it_zip_it_good(output_dir, destination_id, name, html_member, figure_members))
+            html_member.release()
+    finally:
+        for member in figure_members:
+            member.release()
 
-                html_files.remove("index.html")  # don't do this one later
+    return archives
 
-            for h_file in html_files:
-                log.info("Found %s", h_file)
-                os.rename(h_file, "index.html")
-                zip_it_zip_it_good(output_dir, destination_id, h_file, path)
-                os.rename("index.html", h_file)
 
-            # restore if necessary
-            if save_name != "":
-                os.rename(save_name, "index.html")
+# references to report figures, as written by tedana ("./figures/x.png" or "figures/x.png"),
+# starting right after an attribute quote, "url(" or "=", so "myfigures/x.png" is left alone
+FIGURE_REF = re.compile(r"""(?<=["'(=])(?:\./)?figures/([^"'\s)<>]+)""")
 
-        else:
-            log.warning("No *.html files at " + str(path))
 
-    else:
+def encode_figure(path) -> str:
+    """Return a file as a base64 data URI, with its MIME type guessed from its name."""
+    mime_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+    with open(path, "rb") as image_file:
+        return "data:" + mime_type + ";base64," + base64.b64encode(image_file.read()).decode("ascii")
 
-        log.error("Path NOT found: " + str(path))
 
-    os.chdir(FWV0)
+def flatten_image_refs(filename, dest_html, n_threads=None):
+    """Write a copy of an html report with its figures embedded as data URIs.
+
+    The figures of the "figures" folder next to the report are encoded in parallel,
+    then every reference to them is rewritten in a single pass over the document.
+    References to files that are not in the folder are left as they are.
 
-# TODO -- flatten component spatial maps
+    Args:
+        filename (str): html report
+        dest_html (str): self-contained html file to write
+        n_threads (int): number of figures encoded at once
 
-def flatten_image_refs(filename, dest_html):
+    Returns:
+        dest_html (str): the file that was written
+    """
     filename = Path(filename)
-    with open(filename) as inf:
+    with open(filename, encoding="utf-8") as inf:
         txt = inf.read()
-    html1 = BeautifulSoup(txt, 'html.parser')
 
     # look for acompanying figures directory
-    if 'figures' in os.listdir(filename.parent):
-        for f in os.listdir(os.path.join(filename.parent,'figures')):
-            f = Path(os.path.join(filename.parent,'figures',f))
-            with open(f, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read())
-                txt = txt.replace("./figures/"+f.name,
-                                      "data:image/svg+xml;base64, " + encoded_string.decode('utf-8'))
+    figures_dir = filename.parent / "figures"
+    names = []
+    if figures_dir.is_dir():
+        for root, dirs, files in os.walk(figures_dir):
+            dirs.sort()
+            names.extend(Path(root, f).relative_to(figures_dir).as_posix() for f in sorted(files))
+
+    n_threads = n_threads or min(4, allocated_cpus())
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        uris = dict(zip(names, pool.map(lambda name: encode_figure(figures_dir / name), names)))
+
+    txt = FIGURE_REF.sub(lambda m: uris.get(m.group(1), m.group(0)), txt)
 
     log.info("Writing html: %s", dest_html)
 
-    with open(dest_html, "w") as outf:
+    with open(dest_html, "w", encoding="utf-8") as outf:
         outf.write(txt)
 
+    return dest_html
+
+
+def flatten_htmls(output_dir, destination_id, path, n_threads=None):
+    """Write a self-contained copy of all .html files at the given path, with the
+    figures embedded, to <name>_<destination_id>.html in the output folder.
+    Unlike the archives of zip_htmls, these open directly on the Flywheel platform.
+
+    Returns the paths of the html files that were written.
+    """
+
+    log.info("Creating self-contained reports for all html files")
+
+    if not os.path.exists(path):
+        log.error("Path NOT found: " + str(path))
+        return []
+
+    html_files = sorted(glob.glob(os.path.join(glob.escape(str(path)), "*.html")))
+
+    if len(html_files) == 0:
+        log.warning("No *.html files at " + str(path))
+        return []
+
+    reports = []
+    for h_file in html_files:
+        name = os.path.basename(h_file)
+        log.info("Found %s", name)
+        dest_html = os.path.join(output_dir, name[:-5] + "_" + destination_id + ".html")
+        reports.append(flatten_image_refs(h_file, dest_html, n_threads=n_threads))
+
+    return reports